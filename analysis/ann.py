@@ -0,0 +1,239 @@
+"""
+Approximate nearest-neighbor search over author vectors, with an inverted-file (IVF) index.
+
+The L2-normalized vectors are clustered by spherical k-means into n_lists lists, and stored
+sorted by list, so that each list is a contiguous block of rows. A query ranks the list
+centroids by cosine similarity, and scores exactly only the rows of its n_probe best lists.
+Queries touch a small fraction of the rows, so everyone can be indexed, without the
+auth_min / journal_min pruning the notebooks use to keep exact search fast. Raising
+n_probe trades speed for recall.
+
+The index is built once and saved as a folder of .npy files, which load with mmap_mode='r'
+so that opening an index costs nothing until it is queried:
+
+    index = IVFIndex().build(vectors, labels)
+    index.save('data/processed/author_ann')
+    index = IVFIndex.load('data/processed/author_ann')
+    index.most_similar('MORRISON, Toni', k=10)
+
+evaluate_recall measures how many of the exact top k neighbors the index finds.
+"""
+import os
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .similarity import SimilarityIndex, _dense, normalize_rows, top_k
+
+ARRAYS = ('centroids', 'vectors', 'ids', 'positions', 'offsets')
+
+def spherical_kmeans(X: np.ndarray, n_clusters: int, n_iter: int = 10, block_size: int = 10000,
+    seed: int = 0):
+    """
+    Clusters the unit-length rows of X by cosine similarity. Returns the unit-length
+    centroids and the cluster of each row. Empty clusters are restarted at a random row.
+    """
+
+    rng = np.random.default_rng(seed)
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign(X, centroids, block_size)
+        membership = sparse.csr_matrix(
+            (np.ones(len(X), dtype=X.dtype), (assignments, np.arange(len(X)))),
+            shape=(n_clusters, len(X)))
+        sums = np.asarray(membership @ X)
+        empty = np.flatnonzero(np.bincount(assignments, minlength=n_clusters) == 0)
+        sums[empty] = X[rng.choice(len(X), len(empty), replace=False)]
+        centroids = normalize_rows(sums, X.dtype)
+    return centroids, assign(X, centroids, block_size)
+
+def assign(X: np.ndarray, centroids: np.ndarray, block_size: int = 10000) -> np.ndarray:
+    """Index of the most similar centroid of each row, computed block_size rows at a time."""
+
+    assignments = np.empty(len(X), dtype=np.int64)
+    for start in range(0, len(X), block_size):
+        assignments[start:start+block_size] = np.argmax(X[start:start+block_size] @ centroids.T, axis=1)
+    return assignments
+
+class IVFIndex:
+    """
+    :param int n_lists: number of clusters; defaults to the square root of the number of rows
+    :param int n_probe: number of lists scored per query
+    :param int n_iter: k-means iterations
+    :param int sample_size: number of rows k-means is fitted on; all rows are then assigned.
+        n_lists is capped at the number of rows sampled
+    :param int seed: seed for k-means
+    """
+
+    def __init__(self, n_lists: int = None, n_probe: int = 16, n_iter: int = 10,
+        sample_size: int = 100000, seed: int = 0):
+
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def build(self, vectors, labels=None, dtype=np.float32):
+        """
+        Indexes the rows of vectors (DataFrame, array or sparse matrix). Vectors are
+        L2-normalized and stored densely, so that candidates can be scored exactly.
+        """
+
+        if isinstance(vectors, pd.DataFrame):
+            labels = vectors.index if labels is None else labels
+            vectors = vectors.to_numpy()
+        X = _dense(normalize_rows(vectors, dtype))
+        self.labels = pd.Index(labels if labels is not None else range(len(X)))
+
+        rng = np.random.default_rng(self.seed)
+        sample = X if len(X) <= self.sample_size else X[rng.choice(len(X), self.sample_size, replace=False)]
+        # k-means can't fit more centroids than it has rows
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(X))))
+        n_lists = min(n_lists, len(sample))
+        self.centroids, _ = spherical_kmeans(sample, n_lists, self.n_iter, seed=self.seed)
+        self.n_lists = n_lists
+
+        assignments = assign(X, self.centroids)
+        # rows sorted by list, so that each list is a contiguous block
+        self.ids = np.argsort(assignments, kind='stable')
+        self.vectors = X[self.ids]
+        self.positions = np.empty_like(self.ids)
+        self.positions[self.ids] = np.arange(len(self.ids))
+        self.offsets = np.searchsorted(assignments[self.ids], np.arange(n_lists + 1))
+        return self
+
+    def vector(self, row: int) -> np.ndarray:
+        """The normalized vector of a row, in the order the rows were given to build."""
+
+        return np.asarray(self.vectors[self.positions[row]])
+
+    def search(self, queries, k: int = 5, exclude: np.ndarray = None, n_probe: int = None):
+        """
+        Returns the row indices and cosine similarities of the (approximately) k rows most
+        similar to each query vector, best first. Queries whose lists hold fewer than k
+        rows get -1 / -inf in the missing places.
+
+        :param queries: 2-d array (or sparse matrix) of query vectors, one per row
+        :param int k: number of neighbors per query
+        :param exclude: optional row index to leave out for each query (e.g. the query itself)
+        :param int n_probe: overrides the number of lists scored per query
+        """
+
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        queries = _dense(normalize_rows(queries, self.vectors.dtype))
+        best_lists, _ = top_k(queries @ np.asarray(self.centroids).T, n_probe)
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=self.vectors.dtype)
+        for i, query in enumerate(queries):
+            ids = []
+            list_scores = []
+            for lst in best_lists[i]:
+                start, stop = self.offsets[lst], self.offsets[lst + 1]
+                ids.append(self.ids[start:stop])
+                list_scores.append(self.vectors[start:stop] @ query)
+            ids = np.concatenate(ids)
+            list_scores = np.concatenate(list_scores)
+            if exclude is not None:
+                list_scores[ids == exclude[i]] = -np.inf
+            best, best_scores = top_k(list_scores[None, :], k)
+            found = np.isfinite(best_scores[0])
+            n_found = found.sum()
+            indices[i, :n_found] = ids[best[0][found]]
+            scores[i, :n_found] = best_scores[0][found]
+        return indices, scores
+
+    def most_similar(self, labels, k: int = 5, n_probe: int = None):
+        """
+        Returns the cosine similarities of the rows most similar to the row with the given
+        label, best first, as a Series indexed by label. The row itself is left out. Given
+        a list of labels, returns a dict of Series.
+        """
+
+        single = np.isscalar(labels)
+        labels = [labels] if single else list(labels)
+        rows = self.labels.get_indexer(labels)
+        if (rows < 0).any():
+            missing = [label for label, row in zip(labels, rows) if row < 0]
+            raise KeyError(f'Not in index: {missing}')
+
+        queries = np.stack([self.vector(row) for row in rows])
+        indices, scores = self.search(queries, k, exclude=rows, n_probe=n_probe)
+        results = {}
+        for label, row_indices, row_scores in zip(labels, indices, scores):
+            found = row_indices >= 0
+            results[label] = pd.Series(row_scores[found], index=self.labels[row_indices[found]],
+                name='cosine_similarity')
+        return results[labels[0]] if single else results
+
+    def save(self, path: str):
+        """Saves the index as a folder of .npy files plus its labels and parameters."""
+
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'labels.json'), 'w') as f:
+            # keep the dtype, so that e.g. integer labels don't come back as another type
+            json.dump({'dtype': str(self.labels.dtype), 'labels': self.labels.tolist()}, f)
+        with open(os.path.join(path, 'params.json'), 'w') as f:
+            json.dump({
+                'n_lists': self.n_lists,
+                'n_probe': self.n_probe,
+                'n_iter': self.n_iter,
+                'sample_size': self.sample_size,
+                'seed': self.seed,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        Loads an index saved with save. With mmap, the arrays are memory-mapped rather
+        than read into memory.
+        """
+
+        with open(os.path.join(path, 'params.json')) as f:
+            index = cls(**json.load(f))
+        mmap_mode = 'r' if mmap else None
+        for name in ARRAYS:
+            setattr(index, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(path, 'labels.json')) as f:
+            labels = json.load(f)
+        index.labels = pd.Index(labels['labels'], dtype=labels['dtype'])
+        return index
+
+def evaluate_recall(index: IVFIndex, k: int = 10, n_queries: int = 200, n_probe: int = None,
+    seed: int = 0) -> dict:
+    """
+    Compares the index with exact search, one query at a time, on a random sample of its
+    own rows. Returns recall@k (the share of the exact top k the index found) and the
+    time per query of each.
+    """
+
+    vectors = np.asarray(index.vectors)
+    exact = SimilarityIndex(vectors, index.labels[index.ids])
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index.labels), size=min(n_queries, len(index.labels)), replace=False)
+    queries = np.stack([index.vector(row) for row in rows])
+
+    start = time.perf_counter()
+    exact_indices = np.concatenate([
+        # the exact index holds the rows in the index's sorted order
+        index.ids[exact.search(query[None, :], k, exclude=[index.positions[row]])[0]]
+        for query, row in zip(queries, rows)
+    ])
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ann_indices, _ = index.search(queries, k, exclude=rows, n_probe=n_probe)
+    ann_seconds = time.perf_counter() - start
+
+    found = sum(len(np.intersect1d(a[a >= 0], e)) for a, e in zip(ann_indices, exact_indices))
+    return {
+        'recall': found / exact_indices.size,
+        'ann_ms_per_query': 1000 * ann_seconds / len(rows),
+        'exact_ms_per_query': 1000 * exact_seconds / len(rows),
+    }
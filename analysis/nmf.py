@@ -0,0 +1,306 @@
+"""
+Nonnegative matrix factorization with an explicit observation mask.
+
+crossval_nmf holds data out by setting it to zero, so the held-out cells are still fitted,
+as zeros. masked_nmf instead minimizes the squared error over the observed cells only,
+with the multiplicative updates of Lee and Seung weighted by the mask:
+
+    H <- H * W'(M * X) / W'(M * WH)
+    W <- W * (M * X)H' / (M * WH)H'
+
+M * WH is never formed densely. The mask is given as a list of cells, either the cells
+held out (the rest being observed) or the cells observed (the rest being missing), and
+W @ H is only evaluated on those cells, in blocks of rows. With held-out cells,
+W'(M * WH) = (W'W)H - W'(WH on the held-out cells), so an iteration costs a sparse
+product with X plus work proportional to the number of listed cells, rather than to the
+size of the matrix. X can be a scipy sparse matrix, and everything is computed in float32
+by default.
+
+    cells = random_holdout(X.shape, fraction=0.1)
+    result = masked_nmf(X, 10, holdout=cells)
+    test_err = cell_error(X, result.W, result.H, cells)
+"""
+import math
+from typing import NamedTuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+# added to the denominators of the updates, as sklearn does
+EPSILON = np.finfo(np.float32).eps
+
+# a dense product costs about as much per cell of W @ H as a cell-by-cell one costs per
+# listed cell divided by this, so blocks with more than 1/64 of their cells listed are
+# computed densely
+DENSE_BLOCK_RATIO = 64
+
+class NMFResult(NamedTuple):
+    W: np.ndarray
+    H: np.ndarray
+    n_iter: int
+    train_err: float        # Frobenius norm of the residual on the observed cells
+
+def quadrant_bounds(shape, fold: int):
+    """Row and column bounds of the quadrant crossval_nmf holds out in fold (0-3)."""
+
+    rows, cols = shape
+    mid_rows = int(rows / 2)
+    mid_cols = int(cols / 2)
+    quadrants = {
+        0: [[0, mid_rows], [0, mid_cols]],
+        1: [[0, mid_rows], [mid_cols, cols]],
+        2: [[mid_rows, rows], [0, mid_cols]],
+        3: [[mid_rows, rows], [mid_cols, cols]],
+    }
+    return quadrants[fold]
+
+def quadrant_holdout(shape, fold: int):
+    """Rows and columns of the cells in the quadrant held out in fold."""
+
+    (row_start, row_stop), (col_start, col_stop) = quadrant_bounds(shape, fold)
+    rows = np.arange(row_start, row_stop)
+    cols = np.arange(col_start, col_stop)
+    return np.repeat(rows, len(cols)), np.tile(cols, len(rows))
+
+def random_holdout(shape, fraction: float = 0.1, seed: int = 0):
+    """Rows and columns of a random fraction of the cells of a matrix, zero or not."""
+
+    rng = np.random.default_rng(seed)
+    n_cells = shape[0] * shape[1]
+    cells = np.sort(rng.choice(n_cells, size=int(round(fraction * n_cells)), replace=False))
+    return np.divmod(cells, shape[1])
+
+def cell_values(X, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """Values of the given cells of a dense or sparse matrix."""
+
+    if sparse.issparse(X):
+        return np.asarray(sparse.csr_matrix(X)[rows, cols]).ravel()
+    return np.asarray(X)[rows, cols]
+
+class _Cells:
+    """A fixed set of cells, sorted by row, on which W @ H is evaluated a block at a time."""
+
+    def __init__(self, rows, cols, shape, block_size: int):
+
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        order = np.lexsort((cols, rows))
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(self.rows, minlength=shape[0]))])
+        self.shape = shape
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+
+        return len(self.rows)
+
+    def product(self, W: np.ndarray, H: np.ndarray) -> np.ndarray:
+        """
+        (W @ H)[rows, cols], without forming W @ H. Rows are taken in blocks of about
+        block_size cells of W @ H; a block with many listed cells is computed densely
+        and indexed, and one with few is computed a cell at a time.
+        """
+
+        HT = np.ascontiguousarray(H.T)
+        values = np.empty(len(self), dtype=W.dtype)
+        n_rows, n_cols = self.shape
+        block_rows = max(1, self.block_size // n_cols)
+        for row_start in range(0, n_rows, block_rows):
+            row_stop = min(row_start + block_rows, n_rows)
+            start, stop = self.indptr[row_start], self.indptr[row_stop]
+            if start == stop:
+                continue
+            rows, cols = self.rows[start:stop], self.cols[start:stop]
+            if (stop - start) * DENSE_BLOCK_RATIO > (row_stop - row_start) * n_cols:
+                values[start:stop] = (W[row_start:row_stop] @ H)[rows - row_start, cols]
+            else:
+                values[start:stop] = np.einsum('ij,ij->i', W[rows], HT[cols])
+        return values
+
+    def matrix(self, values: np.ndarray) -> sparse.csr_matrix:
+        """A sparse matrix holding values in the cells."""
+
+        return sparse.csr_matrix((values, self.cols, self.indptr), shape=self.shape)
+
+def nndsvda(X, n_components: int, fill: float = None):
+    """
+    Nonnegative double SVD initialization (Boutsidis and Gallopoulos 2008), with the zeros
+    it leaves filled with fill, by default the mean of X. Multiplicative updates can never
+    move an entry away from zero, so they need the zeros filled.
+    """
+
+    if n_components < min(X.shape) - 1:
+        U, S, VT = svds(X.astype(np.float64), k=n_components)
+        order = np.argsort(-S)
+        U, S, VT = U[:, order], S[order], VT[order]
+    else:
+        dense = X.toarray() if sparse.issparse(X) else np.asarray(X)
+        U, S, VT = np.linalg.svd(dense.astype(np.float64), full_matrices=False)
+        U, S, VT = U[:, :n_components], S[:n_components], VT[:n_components]
+
+    W = np.zeros((X.shape[0], n_components))
+    H = np.zeros((n_components, X.shape[1]))
+    W[:, 0] = np.sqrt(S[0]) * np.abs(U[:, 0])
+    H[0] = np.sqrt(S[0]) * np.abs(VT[0])
+    for j in range(1, n_components):
+        x, y = U[:, j], VT[j]
+        # keep whichever of the positive and negative parts carries more of the component
+        x_pos, x_neg = np.maximum(x, 0), np.maximum(-x, 0)
+        y_pos, y_neg = np.maximum(y, 0), np.maximum(-y, 0)
+        x_pos_norm, y_pos_norm = np.linalg.norm(x_pos), np.linalg.norm(y_pos)
+        x_neg_norm, y_neg_norm = np.linalg.norm(x_neg), np.linalg.norm(y_neg)
+        if x_pos_norm * y_pos_norm >= x_neg_norm * y_neg_norm:
+            u, v, sigma = x_pos / max(x_pos_norm, EPSILON), y_pos / max(y_pos_norm, EPSILON), x_pos_norm * y_pos_norm
+        else:
+            u, v, sigma = x_neg / max(x_neg_norm, EPSILON), y_neg / max(y_neg_norm, EPSILON), x_neg_norm * y_neg_norm
+        scale = np.sqrt(S[j] * sigma)
+        W[:, j] = scale * u
+        H[j] = scale * v
+
+    fill = X.mean() if fill is None else fill
+    W[W < EPSILON] = fill
+    H[H < EPSILON] = fill
+    return W, H
+
+def _masked_left(W: np.ndarray, H: np.ndarray, cells: _Cells, holdout: bool) -> np.ndarray:
+    """W'(M * WH)."""
+
+    if cells is None:
+        return (W.T @ W) @ H
+    P = cells.matrix(cells.product(W, H))
+    if holdout:
+        # can come out a rounding error below zero
+        return np.maximum((W.T @ W) @ H - (P.T @ W).T, 0)
+    return (P.T @ W).T
+
+def _masked_right(W: np.ndarray, H: np.ndarray, cells: _Cells, holdout: bool) -> np.ndarray:
+    """(M * WH)H'."""
+
+    if cells is None:
+        return W @ (H @ H.T)
+    P = cells.matrix(cells.product(W, H))
+    if holdout:
+        return np.maximum(W @ (H @ H.T) - P @ H.T, 0)
+    return P @ H.T
+
+def _observed_error(X_obs, X_obs_sq: float, W: np.ndarray, H: np.ndarray, cells: _Cells, holdout: bool) -> float:
+    """
+    Frobenius norm of the residual on the observed cells, as
+    |M * X|^2 - 2 <M * X, WH> + |M * WH|^2, summed in float64.
+    """
+
+    cross = np.sum(W * (X_obs @ H.T), dtype=np.float64)
+    if cells is None or holdout:
+        wh_sq = np.sum((W.T @ W) * (H @ H.T), dtype=np.float64)
+        if cells is not None:
+            values = cells.product(W, H).astype(np.float64)
+            wh_sq -= values @ values
+    else:
+        values = cells.product(W, H).astype(np.float64)
+        wh_sq = values @ values
+    return math.sqrt(max(X_obs_sq - 2 * cross + wh_sq, 0.0))
+
+def masked_nmf(X, n_components: int, holdout=None, observed=None, W: np.ndarray = None,
+    H: np.ndarray = None, init: str = 'nndsvda', max_iter: int = 500, tol: float = 1e-4, check_every: int = 10,
+    dtype=np.float32, block_size: int = 1 << 18, seed: int = 0) -> NMFResult:
+    """
+    Factorizes X ~ W @ H, minimizing the squared error over the observed cells only.
+
+    :param X: nonnegative dense array or sparse matrix
+    :param int n_components: number of components
+    :param holdout: (rows, cols) of cells left out of the fit; every other cell is observed
+    :param observed: (rows, cols) of the only cells observed, for matrices with missing
+        values; give holdout or observed, not both. Given neither, every cell is observed
+    :param W: initial W, e.g. to warm-start from a previous fit
+    :param H: initial H
+    :param str init: how to initialize W and H if they aren't given: 'nndsvda', from the
+        SVD of X with the held-out cells zeroed, or 'random'
+    :param int max_iter: maximum number of iterations
+    :param float tol: the fit has converged once check_every iterations lower the error
+        on the observed cells by less than this share
+    :param int check_every: how often to compute the error
+    :param dtype: dtype of the computation
+    :param int block_size: number of cells of W @ H computed at a time
+    :param int seed: seed for init='random'
+    """
+
+    if holdout is not None and observed is not None:
+        raise ValueError('Give either the held-out cells or the observed cells, not both')
+    if init not in ('nndsvda', 'random'):
+        raise ValueError(f"Unknown init {init!r}; choose 'nndsvda' or 'random'")
+
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=dtype)
+        smallest = X.data.min() if X.nnz else 0
+    else:
+        X = np.asarray(X, dtype=dtype)
+        smallest = X.min()
+    if smallest < 0:
+        raise ValueError('NMF needs a nonnegative matrix')
+
+    n_rows, n_cols = X.shape
+    cells = None
+    is_holdout = observed is None
+    if holdout is not None or observed is not None:
+        cells = _Cells(*(holdout if is_holdout else observed), X.shape, block_size)
+    if cells is None:
+        n_observed = n_rows * n_cols
+    else:
+        n_observed = n_rows * n_cols - len(cells) if is_holdout else len(cells)
+
+    # X restricted to the observed cells, which is all the updates ever read of it
+    if cells is None:
+        X_obs = X
+    elif is_holdout and sparse.issparse(X):
+        X_obs = X - cells.matrix(cell_values(X, cells.rows, cells.cols))
+        X_obs.eliminate_zeros()
+    elif is_holdout:
+        X_obs = X.copy()
+        X_obs[cells.rows, cells.cols] = 0
+    else:
+        X_obs = cells.matrix(cell_values(X, cells.rows, cells.cols))
+    X_obs_sq = float(X_obs.multiply(X_obs).sum() if sparse.issparse(X_obs) else np.sum(X_obs ** 2, dtype=np.float64))
+
+    if (W is None or H is None) and init == 'nndsvda':
+        W, H = nndsvda(X_obs, n_components, fill=X_obs.sum() / n_observed)
+    elif W is None or H is None:
+        rng = np.random.default_rng(seed)
+        scale = math.sqrt(X_obs.sum() / n_observed / n_components)
+        W = scale * rng.random((n_rows, n_components))
+        H = scale * rng.random((n_components, n_cols))
+    W = np.array(W, dtype=dtype)
+    H = np.array(H, dtype=dtype)
+
+    n_iter = 0
+    last_err = None
+    err = None
+    while n_iter < max_iter:
+        n_iter += 1
+
+        # H <- H * W'(M * X) / W'(M * WH)
+        denominator = _masked_left(W, H, cells, is_holdout)
+        H *= (X_obs.T @ W).T / (denominator + EPSILON)
+
+        # W <- W * (M * X)H' / (M * WH)H'
+        denominator = _masked_right(W, H, cells, is_holdout)
+        W *= (X_obs @ H.T) / (denominator + EPSILON)
+
+        if n_iter % check_every == 0:
+            err = _observed_error(X_obs, X_obs_sq, W, H, cells, is_holdout)
+            if last_err is not None and last_err - err < tol * last_err:
+                break
+            last_err = err
+
+    if err is None or n_iter % check_every:
+        err = _observed_error(X_obs, X_obs_sq, W, H, cells, is_holdout)
+    return NMFResult(W, H, n_iter, err)
+
+def cell_error(X, W: np.ndarray, H: np.ndarray, cells, block_size: int = 1 << 18) -> float:
+    """Frobenius norm of the residual of X ~ W @ H on the given (rows, cols) cells, e.g. the held-out ones."""
+
+    rows, cols = cells
+    cells = _Cells(rows, cols, X.shape, block_size)
+    residual = cell_values(X, cells.rows, cells.cols).astype(np.float64) - cells.product(W, H)
+    return float(math.sqrt(residual @ residual))
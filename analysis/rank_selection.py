@@ -0,0 +1,340 @@
+"""
+Cross-validated selection of the number of NMF components, as in crossval_nmf.ipynb.
+
+For each k and each of four folds, NMF is fitted with a quadrant of the matrix held out
+(see crossval_matrices), and the train and test reconstruction errors are recorded; the
+best k has the lowest mean test error. Unlike the notebook's loop, fits run in a process
+pool, and each fit can warm-start from the solution for k-1 on the same fold, with a new
+component added, which needs far fewer iterations than a fit from scratch.
+
+Warm starts make the fits for one fold a chain. To keep the pool busy, the range of k is
+cut into segments, each a chain of its own that starts cold, and (fold, segment) chains
+are spread across the workers. A chain can also stop early, once the test error has failed
+to improve for patience values of k in a row.
+
+Zeroing a quadrant still fits the held-out cells, as zeros. With solver='masked', fits use
+masked_nmf from analysis/nmf.py instead, which leaves the held-out cells out of the loss,
+takes sparse input, and can hold out random cells rather than quadrants (holdout='random').
+
+Run from the repo root to select k for the TF-IDF weighted matrix the notebook uses:
+
+    python -m analysis.rank_selection --workers 8
+"""
+import os
+import math
+import json
+import time
+import random
+import argparse
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+
+from .nmf import masked_nmf, cell_error, quadrant_bounds, quadrant_holdout, random_holdout
+
+FOLDS = 4
+SOLVERS = ('sklearn', 'masked')
+HOLDOUTS = ('quadrant', 'random')
+
+def crossval_matrices(X: np.ndarray, fold: int):
+    """
+    Given a matrix X, the function creates 4 sets of train + test matrices
+    where each train matrix is masked with zeros in 0.25 of the values, and the
+    test matrix is masked zeros in 0.75 of them.
+    X - numpy array
+    fold - is an integer from 0-3.
+    Returns the masked data and also the masks for train and test
+    """
+
+    rows, cols = X.shape
+    (row_start, row_stop), (col_start, col_stop) = quadrant_bounds(X.shape, fold)
+
+    train_mask = np.full((rows, cols), 1)
+    train_mask[row_start:row_stop, col_start:col_stop] = 0
+    test_mask = 1 - train_mask
+
+    X_train = X.copy()
+    X_train[train_mask == 0] = 0
+    X_test = X.copy()
+    X_test[train_mask == 1] = 0
+
+    return X_train, X_test, train_mask, test_mask
+
+def grow(W: np.ndarray, H: np.ndarray, X: np.ndarray, seed: int = 0):
+    """
+    Returns W and H with one more component, initialized with small random values on the
+    scale nndsvd would give it, so that a fit for k can start from the one for k-1.
+    """
+
+    rng = np.random.default_rng(seed)
+    scale = math.sqrt(X.mean() / (W.shape[1] + 1))
+    W = np.hstack([W, scale * rng.random((W.shape[0], 1))]).astype(X.dtype)
+    H = np.vstack([H, scale * rng.random((1, H.shape[1]))]).astype(X.dtype)
+    return W, H
+
+def fit_nmf(X_train: np.ndarray, k: int, max_iter: int = 5000, tol: float = 1e-4, random_state: int = 99,
+    W_init: np.ndarray = None, H_init: np.ndarray = None, check_every: int = 25):
+    """
+    Fits sklearn's NMF, from nndsvd or from the given W and H. Returns W, H and the
+    iterations used.
+
+    The fit runs check_every iterations at a time, each run starting from where the last
+    stopped, and stops once a run lowers the reconstruction error by less than tol
+    (relative). sklearn's own tol is relative to the state at initialization, so a good
+    warm start would make it harder, not easier, to converge.
+    """
+
+    from sklearn.decomposition import NMF
+    from sklearn.exceptions import ConvergenceWarning
+
+    W, H = W_init, H_init
+    n_iter = 0
+    last_err = None
+    with warnings.catch_warnings():
+        # every run but the last stops at its max_iter
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        while n_iter < max_iter:
+            steps = min(check_every, max_iter - n_iter)
+            if W is None:
+                model = NMF(n_components=k, init='nndsvd', random_state=random_state, max_iter=steps, tol=0)
+                W = model.fit_transform(X_train)
+            else:
+                model = NMF(n_components=k, init='custom', random_state=random_state, max_iter=steps, tol=0)
+                W = model.fit_transform(X_train, W=W, H=H)
+            H = model.components_
+            n_iter += model.n_iter_
+            err = model.reconstruction_err_
+            if last_err is not None and last_err - err < tol * last_err:
+                break
+            last_err = err
+    return W, H, n_iter
+
+def reconstruction_errors(X_train, X_test, train_mask, test_mask, W, H):
+    """Frobenius norm of the residual on the training cells and on the held-out cells."""
+
+    X_est = W @ H
+    train_err = linalg.norm(train_mask * (X_train - X_est), ord='fro')
+    test_err = linalg.norm(test_mask * (X_test - X_est), ord='fro')
+    return train_err, test_err
+
+# each worker process receives the matrix once, rather than with every task
+_worker_X = None
+
+def _init_worker(X: np.ndarray, blas_threads: int = None):
+
+    global _worker_X
+    _worker_X = X
+    if blas_threads:
+        # one BLAS thread per worker, rather than every worker using every core
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(blas_threads)
+
+def _run_chain(args):
+    """Fits one fold for a run of consecutive k, warm-starting each from the last."""
+
+    fold, ks, options = args
+    X = _worker_X
+    masked = options['solver'] == 'masked'
+    if masked and options['holdout'] == 'random':
+        cells = random_holdout(X.shape, options['holdout_fraction'], seed=options['random_state'] + fold)
+    elif masked:
+        cells = quadrant_holdout(X.shape, fold)
+    else:
+        X_train, X_test, train_mask, test_mask = crossval_matrices(X, fold)
+    max_iter, tol, random_state = options['max_iter'], options['tol'], options['random_state']
+
+    fits = []
+    W = H = None
+    best_test_err = math.inf
+    worse = 0
+    for k in ks:
+        start = time.time()
+        W_init = H_init = None
+        if options['warm_start'] and W is not None:
+            W_init, H_init = grow(W, H, X if masked else X_train, seed=random_state + k)
+        if masked:
+            result = masked_nmf(X, k, holdout=cells, W=W_init, H=H_init, max_iter=max_iter, tol=tol,
+                seed=random_state)
+            W, H, n_iter = result.W, result.H, result.n_iter
+            train_err, test_err = result.train_err, cell_error(X, W, H, cells)
+        else:
+            W, H, n_iter = fit_nmf(X_train, k, max_iter, tol, random_state, W_init, H_init)
+            train_err, test_err = reconstruction_errors(X_train, X_test, train_mask, test_mask, W, H)
+        fits.append({
+            'k': int(k),
+            'fold': fold,
+            'train_err': float(train_err),
+            'test_err': float(test_err),
+            'n_iter': int(n_iter),
+            'seconds': time.time() - start,
+        })
+
+        if options['patience']:
+            if test_err < best_test_err:
+                best_test_err = test_err
+                worse = 0
+            else:
+                worse += 1
+                if worse >= options['patience']:
+                    break
+    return fits
+
+def select_rank(X, ks=range(2, 30), folds: int = FOLDS, workers: int = 1,
+    warm_start: bool = True, segments: int = None, max_iter: int = 5000, tol: float = 1e-4,
+    patience: int = 0, random_state: int = 99, solver: str = 'sklearn', holdout: str = 'quadrant',
+    holdout_fraction: float = 0.1, verbose: bool = True):
+    """
+    Cross-validates NMF for each k in ks. Returns the error curve (a DataFrame indexed by
+    k with the mean train and test error over folds, and the number of folds fitted), a
+    DataFrame of every individual fit, and the k with the lowest mean test error.
+
+    :param X: nonnegative matrix to factorize; may be sparse with the masked solver
+    :param ks: numbers of components to try, in increasing order
+    :param int folds: number of held-out quadrants to use, up to 4, or of random hold-outs
+    :param int workers: number of worker processes; 1 fits in this process
+    :param bool warm_start: start each fit from the solution for the previous k. Warm
+        starts converge sooner, which can flatten the rise in test error past the best k;
+        with the masked solver, whose fits overfit more visibly, compare with cold starts
+    :param int segments: number of chains the range of k is cut into per fold; defaults
+        to enough to keep every worker busy
+    :param int max_iter: maximum iterations per fit
+    :param float tol: a fit has converged once 25 iterations lower its error by less than
+        this share
+    :param int patience: stop a chain after this many values of k without a lower test
+        error; 0 never stops early
+    :param int random_state: seed for the fits and the random hold-outs
+    :param str solver: 'sklearn', which fits the matrix with the held-out cells set to zero,
+        or 'masked', which leaves them out of the fit
+    :param str holdout: 'quadrant' or, with the masked solver, 'random'
+    :param float holdout_fraction: share of the cells in each random hold-out
+    :param bool verbose: whether to print each fit as it finishes
+    """
+
+    if solver not in SOLVERS:
+        raise ValueError(f'Unknown solver {solver!r}; choose from {SOLVERS}')
+    if holdout not in HOLDOUTS:
+        raise ValueError(f'Unknown hold-out {holdout!r}; choose from {HOLDOUTS}')
+    if holdout == 'random' and solver != 'masked':
+        raise ValueError('Random hold-outs need the masked solver')
+    if holdout == 'quadrant' and folds > FOLDS:
+        raise ValueError(f'There are only {FOLDS} quadrants to hold out')
+
+    options = {
+        'warm_start': warm_start,
+        'max_iter': max_iter,
+        'tol': tol,
+        'patience': patience,
+        'random_state': random_state,
+        'solver': solver,
+        'holdout': holdout,
+        'holdout_fraction': holdout_fraction,
+    }
+    ks = list(ks)
+    if segments is None:
+        segments = max(1, math.ceil(workers / folds)) if warm_start else len(ks)
+    chunks = [list(chunk) for chunk in np.array_split(ks, min(segments, len(ks))) if len(chunk)]
+    tasks = [
+        (fold, chunk, options)
+        for fold in range(folds)
+        # the largest ks are slowest, so start them first
+        for chunk in reversed(chunks)
+    ]
+
+    fits = []
+    pool = None
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker, initargs=(X, 1))
+        chains = pool.imap_unordered(_run_chain, tasks)
+    else:
+        _init_worker(X)
+        chains = map(_run_chain, tasks)
+    try:
+        for chain in chains:
+            fits.extend(chain)
+            if verbose:
+                for fit in chain:
+                    print(f"k: {fit['k']}; fold: {fit['fold']}; train residual {fit['train_err']:.4f}; "
+                          f"test residual {fit['test_err']:.4f}; {fit['n_iter']} iterations")
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    fits = pd.DataFrame(fits).sort_values(['k', 'fold']).reset_index(drop=True)
+    curve = fits.groupby('k').agg(
+        train_err=('train_err', 'mean'),
+        test_err=('test_err', 'mean'),
+        folds=('fold', 'count'),
+    )
+    # only ks fitted on every fold are comparable
+    complete = curve[curve.folds == folds]
+    best_k = int(complete.test_err.idxmin()) if len(complete) else None
+    return curve, fits, best_k
+
+def save_results(dest_path: str, curve: pd.DataFrame, fits: pd.DataFrame, best_k: int):
+    """Writes the error curve to dest_path.tsv, every fit to dest_path.fits.tsv and the best k to dest_path.json."""
+
+    curve.to_csv(dest_path + '.tsv', sep='\t')
+    fits.to_csv(dest_path + '.fits.tsv', sep='\t', index=False)
+    with open(dest_path + '.json', 'w') as f:
+        json.dump({
+            'best_k': best_k,
+            'best_test_err': float(curve.loc[best_k, 'test_err']) if best_k is not None else None,
+        }, f, indent=2)
+
+def main(counts_path: str = os.path.join('data', 'processed', 'book_reviews.tsv'),
+    dest_path: str = os.path.join('data', 'processed', 'rank_selection'), k_min: int = 2, k_max: int = 30,
+    workers: int = 1, warm_start: bool = True, max_iter: int = 5000, patience: int = 0,
+    solver: str = 'sklearn', holdout: str = 'quadrant', holdout_fraction: float = 0.1):
+
+    from .weighting import weighted_matrix
+
+    # same data as crossval_nmf.ipynb: TF-IDF weighted, shuffled, and shifted to be positive
+    tfidf = weighted_matrix(counts_path, 'TFIDF', auth_min=20, journal_min=25).frame()
+    tfidf = tfidf.sample(frac=1, random_state=99)
+    random.seed(99)
+    shuffled_cols = list(tfidf.columns)
+    random.shuffle(shuffled_cols)
+    if solver == 'masked':
+        # held-out cells aren't zeroed, so there is no need to shift the data
+        data = sparse.csr_matrix(tfidf[shuffled_cols].to_numpy())
+    else:
+        data = (tfidf[shuffled_cols] + 1).to_numpy()
+
+    curve, fits, best_k = select_rank(data, ks=range(k_min, k_max), workers=workers,
+        warm_start=warm_start, max_iter=max_iter, patience=patience, solver=solver,
+        holdout=holdout, holdout_fraction=holdout_fraction)
+    save_results(dest_path, curve, fits, best_k)
+    print(curve)
+    if best_k is not None:
+        print(f'Best (lowest) test error is {curve.loc[best_k, "test_err"]}, with {best_k} latent features')
+    else:
+        print('No k was fitted on every fold, so there is no best k')
+
+if __name__=='__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Select the number of NMF components by cross-validation.')
+    arg_parser.add_argument('--counts', default=os.path.join('data', 'processed', 'book_reviews.tsv'))
+    arg_parser.add_argument('--dest', default=os.path.join('data', 'processed', 'rank_selection'),
+        help='output path, without extension')
+    arg_parser.add_argument('--k-min', type=int, default=2)
+    arg_parser.add_argument('--k-max', type=int, default=30, help='exclusive')
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--cold-start', action='store_true', help='fit every k from scratch')
+    arg_parser.add_argument('--max-iter', type=int, default=5000)
+    arg_parser.add_argument('--patience', type=int, default=0,
+        help='stop a chain after this many ks without a lower test error')
+    arg_parser.add_argument('--solver', choices=SOLVERS, default='sklearn',
+        help='masked leaves the held-out cells out of the fit, rather than fitting them as zeros')
+    arg_parser.add_argument('--holdout', choices=HOLDOUTS, default='quadrant',
+        help='hold out quadrants, or (with the masked solver) random cells')
+    arg_parser.add_argument('--holdout-fraction', type=float, default=0.1,
+        help='share of the cells in each random hold-out')
+    args = arg_parser.parse_args()
+
+    main(counts_path=args.counts, dest_path=args.dest, k_min=args.k_min, k_max=args.k_max,
+        workers=args.workers, warm_start=not args.cold_start, max_iter=args.max_iter,
+        patience=args.patience, solver=args.solver, holdout=args.holdout,
+        holdout_fraction=args.holdout_fraction)
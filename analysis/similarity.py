@@ -0,0 +1,136 @@
+"""
+Top-k cosine similarity between rows of a weighted matrix, e.g. authors by PMI-weighted
+journal counts or by NMF components.
+
+The rows are L2-normalized once, so that the cosine similarity of a batch of queries
+against every row is a single matrix product, and the k best rows of each query are
+found with argpartition rather than a full sort. all_pairs finds the k nearest neighbors
+of every row a block of rows at a time, so its memory use is block_size x n_rows.
+"""
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+def normalize_rows(X, dtype=np.float32):
+    """Scales each row of a dense or sparse matrix to unit L2 norm. Rows of zeros stay zero."""
+
+    if sparse.issparse(X):
+        X = sparse.csr_matrix(X, dtype=dtype)
+        norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags((1 / norms).astype(dtype)) @ X
+    X = np.asarray(X, dtype=dtype)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the column indices and values of the k largest scores in each row of a 2-d
+    array, best first.
+    """
+
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+def _dense(X) -> np.ndarray:
+
+    return X.toarray() if sparse.issparse(X) else X
+
+class SimilarityIndex:
+    """
+    Cosine similarity search over the rows of a matrix.
+
+    :param vectors: DataFrame, array or sparse matrix with one row per item
+    :param labels: labels of the rows; taken from the index if vectors is a DataFrame
+    :param dtype: dtype the normalized rows are stored in
+    """
+
+    def __init__(self, vectors, labels=None, dtype=np.float32):
+
+        if isinstance(vectors, pd.DataFrame):
+            labels = vectors.index if labels is None else labels
+            vectors = vectors.to_numpy()
+        self.labels = pd.Index(labels if labels is not None else range(vectors.shape[0]))
+        self.vectors = normalize_rows(vectors, dtype)
+
+    def __len__(self) -> int:
+
+        return self.vectors.shape[0]
+
+    def search(self, queries, k: int = 5, exclude: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the row indices and cosine similarities of the k rows most similar to each
+        query vector, best first.
+
+        :param queries: 2-d array (or sparse matrix) of query vectors, one per row
+        :param int k: number of neighbors per query
+        :param exclude: optional row index to leave out for each query (e.g. the query itself)
+        """
+
+        queries = normalize_rows(queries, self.vectors.dtype)
+        scores = _dense(queries @ self.vectors.T)
+        if exclude is not None:
+            scores[np.arange(len(exclude)), exclude] = -np.inf
+            k = min(k, len(self) - 1)
+        return top_k(scores, k)
+
+    def most_similar(self, labels: Union[str, List[str]], k: int = 5) -> Union[pd.Series, Dict[str, pd.Series]]:
+        """
+        Returns the cosine similarities of the k rows most similar to the row with the given
+        label, best first, as a Series indexed by label. The row itself is left out. Given a
+        list of labels, queries them all in one batch and returns a dict of Series.
+        """
+
+        single = isinstance(labels, str)
+        labels = [labels] if single else list(labels)
+        rows = self.labels.get_indexer(labels)
+        if (rows < 0).any():
+            missing = [label for label, row in zip(labels, rows) if row < 0]
+            raise KeyError(f'Not in index: {missing}')
+
+        indices, scores = self.search(self.vectors[rows], k, exclude=rows)
+        results = {
+            label: pd.Series(row_scores, index=self.labels[row_indices], name='cosine_similarity')
+            for label, row_indices, row_scores in zip(labels, indices, scores)
+        }
+        return results[labels[0]] if single else results
+
+    def all_pairs(self, k: int = 5, block_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the row indices and cosine similarities of the k nearest neighbors of every
+        row (leaving out the row itself), computed block_size rows at a time.
+        """
+
+        n = len(self)
+        k = min(k, n - 1)
+        indices = np.empty((n, k), dtype=np.int64)
+        scores = np.empty((n, k), dtype=self.vectors.dtype)
+        for start in range(0, n, block_size):
+            stop = min(start + block_size, n)
+            block = _dense(self.vectors[start:stop] @ self.vectors.T)
+            block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+            indices[start:stop], scores[start:stop] = top_k(block, k)
+        return indices, scores
+
+    def all_pairs_frame(self, k: int = 5, block_size: int = 1024) -> pd.DataFrame:
+        """all_pairs as a long DataFrame with the columns item, neighbor, rank and similarity."""
+
+        indices, scores = self.all_pairs(k, block_size)
+        n, k = indices.shape
+        return pd.DataFrame({
+            'item': np.repeat(self.labels.to_numpy(), k),
+            'neighbor': self.labels.to_numpy()[indices.ravel()],
+            'rank': np.tile(np.arange(1, k + 1), n),
+            'similarity': scores.ravel(),
+        })
@@ -0,0 +1,239 @@
+"""
+Loading, pruning and weighting of the author x journal review counts used by the notebooks.
+
+Counts are kept in scipy sparse matrices throughout. PMI, PPMI and TF-IDF only ever touch
+the nonzero cells, so their results stay sparse; only the Z-score (and PMI with a nonzero
+offset) has to be dense. weighted_matrix memoizes its results on disk, keyed by a hash of
+the input file and by the pruning thresholds and weighting options, so that the notebooks
+don't redo the work from the raw counts on every run.
+"""
+import os
+import pickle
+import hashlib
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_prep import author_compile, load_counts
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'processed', '.weighting_cache')
+
+# bump whenever the weightings or the layout of the cached data change
+CACHE_VERSION = 1
+
+# authors the OCR'd spreadsheets produce that aren't authors
+BAD_AUTHORS = ['#NAME?']
+
+class Weighted(NamedTuple):
+    matrix: object          # sparse matrix or ndarray, authors x journals
+    authors: pd.Index
+    journals: pd.Index
+
+    def frame(self) -> pd.DataFrame:
+        """The matrix as a dense DataFrame, as the notebooks use it."""
+
+        matrix = self.matrix.toarray() if sparse.issparse(self.matrix) else self.matrix
+        return pd.DataFrame(matrix, index=self.authors, columns=self.journals)
+
+class AuthorCounts(NamedTuple):
+    counts: sparse.csr_matrix   # reviews per author and journal
+    authors: pd.Index
+    journals: pd.Index
+    books: pd.Series            # number of books by each author, including unreviewed ones
+
+    def frame(self) -> pd.DataFrame:
+
+        return pd.DataFrame(self.counts.toarray(), index=self.authors, columns=self.journals)
+
+def _read_book_counts(path: str, chunksize: int = 10000):
+    """
+    Reads book-level counts, either from a dense .tsv with book ids as its first column
+    (as the notebooks use) or from an .npz written by data_prep.save_counts.
+    """
+
+    if path.endswith('.npz'):
+        return load_counts(path[:-len('.npz')])
+
+    # read in chunks, so that the dense table is never in memory all at once
+    blocks = []
+    books = []
+    journals = None
+    for chunk in pd.read_csv(path, sep='\t', index_col=0, chunksize=chunksize):
+        journals = chunk.columns
+        books.append(chunk.index.to_series())
+        blocks.append(sparse.csr_matrix(chunk.fillna(0).to_numpy()))
+    return sparse.vstack(blocks).tocsr(), pd.Index(pd.concat(books)), pd.Index(journals)
+
+def load_author_counts(path: str, auth_min: int = 20, journal_min: int = 25) -> AuthorCounts:
+    """
+    Loads book-level review counts, sums them by author and prunes them with
+    prune_author_counts. Authors are sorted by name.
+    """
+
+    book_counts, books, journals = _read_book_counts(path)
+    counts, authors = author_compile(book_counts, books)
+    author_names = books.to_series().str.split('\\|\\|').str[1].str.strip()
+    books_per_author = author_names.value_counts()
+
+    return prune_author_counts(AuthorCounts(counts, authors, journals, books_per_author), auth_min, journal_min)
+
+def prune_author_counts(author_counts: AuthorCounts, auth_min: int = 20, journal_min: int = 25) -> AuthorCounts:
+    """
+    Prunes sparsely-represented authors and journals, as the notebooks do: authors with
+    fewer than auth_min reviews are dropped first, then journals with fewer than journal_min
+    reviews among the rest. Counts loaded without pruning can be pruned again in memory,
+    rather than read from disk a second time.
+    """
+
+    counts, authors, journals, books_per_author = author_counts
+    keep_authors = ~authors.isin(BAD_AUTHORS)
+    keep_authors &= np.asarray(counts.sum(axis=1)).ravel() >= auth_min
+    counts = counts[keep_authors]
+    authors = authors[keep_authors]
+
+    keep_journals = np.asarray(counts.sum(axis=0)).ravel() >= journal_min
+    counts = counts[:, keep_journals]
+    journals = journals[keep_journals]
+
+    return AuthorCounts(counts.tocsr(), authors, journals, books_per_author.reindex(authors))
+
+def pmi(counts, row_totals=None, offset: float = 0.0):
+    """
+    Pointwise mutual information, as log(1 + P(author, journal) / (P(author) P(journal))),
+    so that cells without reviews stay 0 and the result stays sparse.
+
+    :param counts: sparse matrix of counts, authors x journals
+    :param row_totals: counts P(author) is estimated from; defaults to the row sums of
+        counts, while the notebooks use each author's number of books
+    :param float offset: added to every cell, which makes the result dense
+    """
+
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    total = counts.sum()
+    p_journal = np.asarray(counts.sum(axis=0)).ravel() / total
+    row_totals = np.asarray(counts.sum(axis=1)).ravel() if row_totals is None else np.asarray(row_totals, dtype=np.float64)
+    p_author = row_totals / row_totals.sum()
+
+    coo = counts.tocoo()
+    ratio = (coo.data / total) / (p_author[coo.row] * p_journal[coo.col])
+    weighted = sparse.csr_matrix((np.log1p(ratio), (coo.row, coo.col)), shape=counts.shape)
+    if offset:
+        return weighted.toarray() + offset
+    return weighted
+
+def ppmi(counts, row_totals=None):
+    """
+    Positive pointwise mutual information, max(0, log(P(author, journal) / (P(author) P(journal)))).
+    Sparse, since cells without reviews are 0.
+    """
+
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    total = counts.sum()
+    p_journal = np.asarray(counts.sum(axis=0)).ravel() / total
+    row_totals = np.asarray(counts.sum(axis=1)).ravel() if row_totals is None else np.asarray(row_totals, dtype=np.float64)
+    p_author = row_totals / row_totals.sum()
+
+    coo = counts.tocoo()
+    values = np.maximum(np.log((coo.data / total) / (p_author[coo.row] * p_journal[coo.col])), 0)
+    weighted = sparse.csr_matrix((values, (coo.row, coo.col)), shape=counts.shape)
+    weighted.eliminate_zeros()
+    return weighted
+
+def tfidf(counts):
+    """
+    Counts times the inverse document frequency of each journal, log(n_authors / n_authors
+    reviewed by the journal). Sparse.
+    """
+
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+    with np.errstate(divide='ignore'):
+        idf = np.where(document_frequency > 0, np.log(counts.shape[0] / np.maximum(document_frequency, 1)), 0)
+    return counts @ sparse.diags(idf)
+
+def zscore(counts):
+    """
+    Standardizes each journal to mean 0 and (population) standard deviation 1, as sklearn's
+    StandardScaler does. The result is dense.
+    """
+
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    mean = np.asarray(counts.mean(axis=0)).ravel()
+    mean_of_squares = np.asarray(counts.multiply(counts).mean(axis=0)).ravel()
+    std = np.sqrt(np.maximum(mean_of_squares - mean ** 2, 0))
+    std[std == 0] = 1
+    return (counts.toarray() - mean) / std
+
+WEIGHTINGS = {
+    'PMI': pmi,
+    'PPMI': ppmi,
+    'TFIDF': tfidf,
+    'Z': zscore,
+}
+
+# hashes of files already read in this process, by path, mtime and size
+_file_hashes = {}
+
+def file_hash(path: str) -> str:
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+def _cache_key(path: str, scheme: str, auth_min: int, journal_min: int, options: dict) -> str:
+
+    sources = [path]
+    if path.endswith('.npz'):
+        base = path[:-len('.npz')]
+        sources += [base + '.rows.tsv', base + '.columns.tsv']
+    parts = [str(CACHE_VERSION), scheme, str(auth_min), str(journal_min), repr(sorted(options.items()))]
+    parts += [file_hash(source) for source in sources]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+def weighted_matrix(path: str, scheme: str = 'PMI', auth_min: int = 20, journal_min: int = 25,
+    cache_dir: str = CACHE_DIR, author_counts: AuthorCounts = None, **options) -> Weighted:
+    """
+    Loads and prunes the counts at path with load_author_counts and weights them with
+    the given scheme (PMI, PPMI, TFIDF or Z). PMI and PPMI estimate P(author) from each
+    author's number of books, as the notebooks do. Extra options are passed to the
+    weighting function. Results are cached in cache_dir; pass cache_dir='' to skip it.
+
+    If the counts of path are already loaded, pass them as author_counts and they are
+    pruned in memory on a cache miss, instead of being read again.
+    """
+
+    if scheme not in WEIGHTINGS:
+        raise ValueError(f'Unknown weighting scheme {scheme!r}; choose from {list(WEIGHTINGS)}')
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, _cache_key(path, scheme, auth_min, journal_min, options) + '.pickle')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return Weighted(*pickle.load(f))
+
+    if author_counts is None:
+        author_counts = load_author_counts(path, auth_min, journal_min)
+    else:
+        author_counts = prune_author_counts(author_counts, auth_min, journal_min)
+    if scheme in ('PMI', 'PPMI'):
+        options.setdefault('row_totals', author_counts.books.to_numpy())
+    matrix = WEIGHTINGS[scheme](author_counts.counts, **options)
+    result = Weighted(matrix, author_counts.authors, author_counts.journals)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, so that readers never see a partial result
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(tuple(result), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    return result
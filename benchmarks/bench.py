@@ -0,0 +1,310 @@
+"""
+Benchmarks for the hot paths of parsing and extraction, run on synthetic data so they need
+neither the raw spreadsheets nor the trained models.
+
+Review strings follow the formats described in extract/reviewparser.py (journal - volume -
+month/season - day - year - page number - length, with optional fields, ONL pages, journals
+containing dashes and some dropped dashes), and OCR pages interleave author/title headers
+with runs of them. The tagger benchmarks use tiny, randomly initialized flair taggers built
+on the spot, so their predictions are meaningless but their cost per token is representative
+of the flair machinery around the model. They are skipped if flair is not installed.
+
+Each benchmark reports rows/sec, tokens/sec (where tokens apply) and peak Python memory as
+measured by tracemalloc (which doesn't see allocations made inside torch). Results can be
+saved as a baseline and later runs compared against it:
+
+    python benchmarks/bench.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench.py --baseline benchmarks/baseline.json
+
+Comparison exits with status 1 if any benchmark lost more than --tolerance of its throughput
+or grew its peak memory by more than that. A saved baseline also records the environment it
+was measured in (Python, platform, CPU count, library versions), since throughput is only
+comparable on similar machines. The committed benchmarks/baseline.json was recorded on a
+single-core Linux machine with the pinned numpy and pandas, Python 3.9 and flair 0.10, and
+covers every benchmark. That machine was shared, and throughput varied by up to 40% between
+runs, so regenerate the baseline on your own hardware before relying on the default tolerance.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd
+
+from extract.reviewparser import ReviewParser, TextSentence
+from extract.tokenizer import review_tokens, extract_tokens
+from data_prep import count_reviews
+
+JOURNALS = ['Choice', 'H-Net', 'LJ', 'BL', 'PW', 'KR', 'NYTBR', 'TLS', 'Atl', 'CSM', 'New R',
+    'Sat R', 'SLJ', 'Obs', 'Spec', 'AHR', 'JAH', 'Nat R', 'Am', 'BW', 'WLB', 'Kliatt', 'VQR']
+MONTHS = ['Ja', 'F', 'Mr', 'Ap', 'My', 'Je', 'Jl', 'Ag', 'S', 'O', 'N', 'D',
+    'Spr', 'Sum', 'Fall', 'Win']
+LENGTHS = ['[1-50]', '[51-250]', '[251-500]', '[501+]']
+YEARS = [f'{y:02d}' for y in list(range(65, 100)) + [0]]
+NAMES = ['Smith', 'Jones', 'Brown', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor', 'Clark']
+WORDS = ['The', 'Garden', 'of', 'Night', 'History', 'American', 'Letters', 'Stone', 'River',
+    'and', 'a', 'War', 'Poems', 'Selected', 'Essays', 'Life', 'House', 'Collected']
+
+def make_review(rng: random.Random) -> str:
+    """A single review, with each optional field present at a realistic rate."""
+
+    parts = [rng.choice(JOURNALS)]
+    if rng.random() < 0.7:
+        parts.append(f'v{rng.randint(1, 150)}')
+    date = ''
+    if rng.random() < 0.6:
+        date = rng.choice(MONTHS)
+        # weeklies and dailies give a day of the month, seasonal issues don't
+        if date in MONTHS[:12] and rng.random() < 0.4:
+            date += f' {rng.randint(1, 31)}'
+        date += ' '
+    parts.append(f"{date}'{rng.choice(YEARS)}")
+    if rng.random() < 0.05:
+        parts.append('ONL')
+    else:
+        parts.append(f'p{rng.randint(1, 999)}' + ('a' if rng.random() < 0.05 else ''))
+    if rng.random() < 0.3:
+        parts.append(rng.choice(LENGTHS))
+    return ' - '.join(parts)
+
+def make_review_string(rng: random.Random, noise: float = 0.05) -> str:
+    """One to four reviews, as in a spreadsheet cell, with some dashes lost to OCR."""
+
+    fields = ' - '.join(make_review(rng) for _ in range(rng.randint(1, 4))).split(' - ')
+    text = fields[0]
+    for field in fields[1:]:
+        text += (' ' if rng.random() < noise else ' - ') + field
+    return text
+
+def make_page(rng: random.Random, n_entries: int) -> str:
+    """OCR text of a page of the index: author/title headers, each followed by reviews."""
+
+    lines = []
+    for _ in range(n_entries):
+        author = f'{rng.choice(NAMES).upper()}, {rng.choice(NAMES)}'
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+        lines.append(f'{author} - {title}')
+        for _ in range(rng.randint(1, 3)):
+            lines.append(make_review_string(rng))
+    return '\n'.join(lines) + '\n'
+
+def make_raw_df(rng: random.Random, n_rows: int) -> pd.DataFrame:
+    """A raw spreadsheet: one row per book, with all its reviews in the Review column."""
+
+    rows = []
+    for _ in range(n_rows):
+        rows.append({
+            'Author': f'{rng.choice(NAMES)}, {rng.choice(NAMES)}',
+            'Title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))),
+            'Review': make_review_string(rng),
+        })
+    return pd.DataFrame(rows)
+
+def make_tiny_tagger(tags: list, tmp_dir: str):
+    """
+    A randomly initialized BiLSTM-CRF with small character embeddings, built without
+    downloading anything.
+    """
+
+    from flair.data import Dictionary
+    from flair.embeddings import CharacterEmbeddings
+    from flair.models import SequenceTagger
+
+    chars = Dictionary()
+    for i in range(32, 127):
+        chars.add_item(chr(i))
+    chars.add_item('[newline]')
+    char_path = os.path.join(tmp_dir, 'chars.pickle')
+    chars.save(char_path)
+
+    tag_dictionary = Dictionary(add_unk=False)
+    tag_dictionary.add_item('O')
+    for tag in tags:
+        tag_dictionary.add_item(f'B-{tag}')
+        tag_dictionary.add_item(f'I-{tag}')
+
+    tagger = SequenceTagger(
+        hidden_size=16,
+        embeddings=CharacterEmbeddings(path_to_char_dict=char_path,
+            char_embedding_dim=8, hidden_size_char=8),
+        tag_dictionary=tag_dictionary,
+        tag_type='tag',
+        use_crf=True
+    )
+    tagger.eval()
+    return tagger
+
+def measure(func, repeat: int) -> dict:
+    """Runs func once to warm up, then repeat times; returns the best time and the peak
+    memory of one further, traced run."""
+
+    func()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': best, 'peak_mb': peak / 2**20}
+
+def run(n_rows: int = 5000, n_entries: int = 200, repeat: int = 3, seed: int = 0) -> dict:
+    """Runs every benchmark and returns a dict of results keyed by benchmark name."""
+
+    rng = random.Random(seed)
+    review_strings = [make_review_string(rng) for _ in range(n_rows)]
+    page = make_page(rng, n_entries)
+    raw_df = make_raw_df(rng, n_rows)
+    tag_map = {journal: f'{journal} (title)' for journal in JOURNALS[:-3]}
+
+    review_token_count = sum(len(review_tokens(s)) for s in review_strings)
+    page_token_count = len(extract_tokens(page))
+    regex_parser = ReviewParser()
+    text_sentences = [TextSentence(s) for s in review_strings]
+
+    # name: (function, rows per call, tokens per call)
+    benchmarks = {
+        'review_tokens': (lambda: [review_tokens(s) for s in review_strings],
+            n_rows, review_token_count),
+        'extract_tokens': (lambda: extract_tokens(page), n_entries, page_token_count),
+        'ReviewParser._regex_parse': (
+            lambda: [regex_parser._regex_parse(s) for s in text_sentences], n_rows, None),
+        'data_prep.count_reviews': (lambda: count_reviews(raw_df, tag_map), n_rows, None),
+    }
+
+    try:
+        import flair
+    except ImportError:
+        print('flair is not installed; skipping the tokenizer and tagger benchmarks.')
+    else:
+        import torch
+        from flair.data import Sentence
+        from extract.tokenizer import ReviewTokenizer, ExtractTokenizer
+        from extract.extractor import Extractor
+
+        flair.device = torch.device('cpu')
+        torch.manual_seed(seed)
+        tmp_dir = tempfile.mkdtemp()
+
+        tagger_parser = ReviewParser()
+        tagger_parser.tagger = make_tiny_tagger(['J', 'V', 'M', 'D', 'Y', 'P', 'L'], tmp_dir)
+        tagger_parser.tokenizer = ReviewTokenizer()
+        # the tagger is slow enough that a fraction of the rows is representative
+        tagged_strings = review_strings[:max(1, n_rows // 10)]
+        tagged_tokens = sum(len(review_tokens(s)) for s in tagged_strings)
+
+        def tagger_parse():
+            for s in tagged_strings:
+                tagger_parser._tagger_parse(Sentence(s, use_tokenizer=tagger_parser.tokenizer))
+
+        # an untrained tagger doesn't find two complete entries per chunk, which chunked
+        # extraction needs, so the page is tagged as a single chunk
+        extractor = Extractor(make_tiny_tagger(['A', 'T', 'R'], tmp_dir), ExtractTokenizer(),
+            chunk_size=len(page) + 1)
+
+        benchmarks.update({
+            'ReviewTokenizer.run_tokenize': (
+                lambda: [ReviewTokenizer.run_tokenize(s) for s in review_strings],
+                n_rows, review_token_count),
+            'ExtractTokenizer.run_tokenize': (
+                lambda: ExtractTokenizer.run_tokenize(page), n_entries, page_token_count),
+            'ReviewParser._tagger_parse': (tagger_parse, len(tagged_strings), tagged_tokens),
+            'Extractor.extract': (lambda: extractor.extract(page), n_entries, page_token_count),
+        })
+
+    results = {}
+    for name, (func, rows, tokens) in benchmarks.items():
+        result = measure(func, repeat)
+        result['rows_per_sec'] = rows / result['seconds']
+        if tokens is not None:
+            result['tokens_per_sec'] = tokens / result['seconds']
+        results[name] = result
+        tokens_note = f", {result['tokens_per_sec']:,.0f} tokens/sec" if tokens is not None else ''
+        print(f"{name}: {result['rows_per_sec']:,.0f} rows/sec{tokens_note}, "
+            f"peak {result['peak_mb']:.1f} MB")
+    return results
+
+def environment() -> dict:
+    """Describes the machine and libraries the benchmarks ran with."""
+
+    import numpy as np
+
+    try:
+        import flair
+        flair_version = flair.__version__
+    except ImportError:
+        flair_version = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'flair': flair_version,
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """Returns a description of each regression against the baseline."""
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if result['rows_per_sec'] < old['rows_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rows_per_sec']:,.0f} rows/sec, "
+                f"down from {old['rows_per_sec']:,.0f}")
+        if result['peak_mb'] > old['peak_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak {result['peak_mb']:.1f} MB, "
+                f"up from {old['peak_mb']:.1f} MB")
+    return regressions
+
+def main(n_rows: int = 5000, n_entries: int = 200, repeat: int = 3, baseline_path: str = '',
+    save_baseline_path: str = '', tolerance: float = 0.2) -> int:
+
+    results = run(n_rows=n_rows, n_entries=n_entries, repeat=repeat)
+
+    if save_baseline_path:
+        with open(save_baseline_path, 'w') as f:
+            json.dump(dict(results, environment=environment()), f, indent=2)
+        print(f'Saved baseline to {save_baseline_path}')
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if 'environment' in baseline:
+            print(f"Baseline environment: {baseline['environment']}")
+        regressions = compare(results, baseline, tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print('No regressions against baseline.')
+    return 0
+
+if __name__=='__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Benchmark parsing and extraction on synthetic data.')
+    arg_parser.add_argument('--rows', type=int, default=5000,
+        help='number of synthetic review strings / spreadsheet rows')
+    arg_parser.add_argument('--entries', type=int, default=200,
+        help='number of index entries on the synthetic OCR page')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--baseline', default='', help='baseline results to compare against')
+    arg_parser.add_argument('--save-baseline', default='', help='where to save these results as a baseline')
+    arg_parser.add_argument('--tolerance', type=float, default=0.2,
+        help='fractional loss of throughput (or growth of memory) counted as a regression')
+    args = arg_parser.parse_args()
+    sys.exit(main(n_rows=args.rows, n_entries=args.entries, repeat=args.repeat,
+        baseline_path=args.baseline, save_baseline_path=args.save_baseline,
+        tolerance=args.tolerance))
@@ -0,0 +1,52 @@
+"""
+The character loops that ReviewTokenizer and ExtractTokenizer ran before they were rewritten
+with regular expressions, returning (text, start_position, whitespace_after) tuples. They are
+kept as reference implementations: tests/test_tokenizer.py checks the regex tokenizers against
+them, and tokenizer_bench.py times the two.
+"""
+
+def loop_review_tokens(text: str) -> list:
+    """The character loop of the original ReviewTokenizer.run_tokenize, returning tuples."""
+
+    tokens = []
+    word = ""
+    index = -1
+    for index, char in enumerate(text):
+        if char in " '":
+            if len(word) > 0:
+                tokens.append((word, index - len(word), char == " "))
+            word = ""
+        elif char == "-":
+            if len(word) > 0:
+                tokens.append((word, index - len(word), False))
+            tokens.append(("-", index, text[index+1:index+2] == " "))
+            word = ""
+        else:
+            word += char
+    index += 1
+    if len(word) > 0:
+        tokens.append((word, index - len(word), False))
+    return tokens
+
+def loop_extract_tokens(text: str) -> list:
+    """The character loop of the original ExtractTokenizer.run_tokenize, returning tuples."""
+
+    tokens = []
+    word = ""
+    index = -1
+    for index, char in enumerate(text):
+        if char == " ":
+            if len(word) > 0:
+                tokens.append((word, index - len(word), True))
+            word = ""
+        elif char in "-\n":
+            if len(word) > 0:
+                tokens.append((word, index - len(word), False))
+            tokens.append(("-" if char == "-" else "[newline]", index, text[index+1:index+2] == " "))
+            word = ""
+        else:
+            word += char
+    index += 1
+    if len(word) > 0:
+        tokens.append((word, index - len(word), False))
+    return tokens
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the regex tokenizers against the character loops they replaced
+(kept as reference implementations in reference_tokenizers.py), on the synthetic review
+strings and OCR page of bench.py.
+
+Finding the tokens is faster with the regex (findall alone runs about 2.5x faster than the
+loop on a page of OCR), but building a tuple or a flair Token from each match costs about as
+much as the loop saved, so review_tokens, extract_tokens and run_tokenize all come out within
+about 10-20% of the old loops, in either direction. If flair is installed, run_tokenize is
+compared as well.
+
+    python benchmarks/tokenizer_bench.py
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from extract.tokenizer import review_tokens, extract_tokens
+from reference_tokenizers import loop_review_tokens, loop_extract_tokens
+from bench import make_review_string, make_page, measure
+
+def main(n_rows: int = 5000, n_entries: int = 200, repeat: int = 5, seed: int = 0):
+
+    rng = random.Random(seed)
+    review_strings = [make_review_string(rng) for _ in range(n_rows)]
+    page = make_page(rng, n_entries)
+
+    # name: (old, new)
+    pairs = {
+        'review tokens': (
+            lambda: [loop_review_tokens(s) for s in review_strings],
+            lambda: [review_tokens(s) for s in review_strings]),
+        'extract tokens': (lambda: loop_extract_tokens(page), lambda: extract_tokens(page)),
+    }
+
+    try:
+        from flair.data import Token
+    except ImportError:
+        print('flair is not installed; skipping run_tokenize.')
+    else:
+        from extract.tokenizer import ReviewTokenizer, ExtractTokenizer
+
+        def to_tokens(tuples):
+            return [Token(text=text, start_position=start, whitespace_after=whitespace_after)
+                for text, start, whitespace_after in tuples]
+
+        pairs.update({
+            'ReviewTokenizer.run_tokenize': (
+                lambda: [to_tokens(loop_review_tokens(s)) for s in review_strings],
+                lambda: [ReviewTokenizer.run_tokenize(s) for s in review_strings]),
+            'ExtractTokenizer.run_tokenize': (
+                lambda: to_tokens(loop_extract_tokens(page)),
+                lambda: ExtractTokenizer.run_tokenize(page)),
+        })
+
+    for name, (old, new) in pairs.items():
+        old_seconds = measure(old, repeat)['seconds']
+        new_seconds = measure(new, repeat)['seconds']
+        print(f'{name}: loop {old_seconds*1000:.1f} ms, regex {new_seconds*1000:.1f} ms, '
+            f'{old_seconds / new_seconds:.2f}x')
+
+if __name__=='__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Compare the regex tokenizers with the old character loops.')
+    arg_parser.add_argument('--rows', type=int, default=5000)
+    arg_parser.add_argument('--entries', type=int, default=200)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+    main(n_rows=args.rows, n_entries=args.entries, repeat=args.repeat)
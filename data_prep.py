@@ -1,109 +1,178 @@
-import re, os
-from collections import defaultdict
+import os
+import argparse
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
-def load_tags(path: list, ocr_fixes_path: str):
-    """Returns a dictionary that maps BRI abbreviations to journal titles"""
-
-    # this spreadsheet contains mappings between BRI abbreviations and journal names
-    tag_df = pd.read_csv(path, sep='\t')
+from extract.tagindex import TagIndex
+from reader import iter_batches
+from tagmap import get_tag_map
 
-    # this one contains quick fixes for the most common OCR erros
-    fixes_df = pd.read_csv(ocr_fixes_path, sep='\t')
+# all reviews end with a page number of format p[number]
+# this regex checks for that, as well as common OCR errors identified in testing
+REVIEW_END_PATTERN = r'pi?[A-Z]?[0-9lO!]+ [a-z]?'
 
-    # generate a dict to map between abbreviations and names
-    tag_map = {tag: title for (tag, title) in zip(tag_df['tag'], tag_df['title'])}
-    for tag, title in zip(fixes_df['tag'], fixes_df['title']):
-        if tag not in tag_map:
-            tag_map[tag] = title
+def load_tags(path: list, ocr_fixes_path: str):
+    """Returns a dictionary that maps BRI abbreviations to journal titles.
 
-    # the most common OCR error is a missing space
-    # luckily, we can safely strip spaces and check against that
-    for tag in list(tag_map):
-        if ' ' in tag:
-            tag_map[tag.replace(' ', '')] = tag_map[tag]
+    path may be a single tag spreadsheet or a list of them; later spreadsheets
+    take precedence over earlier ones. The map is built by tagmap, which caches it."""
 
-    return tag_map
+    paths = [path] if isinstance(path, str) else path
+    return dict(get_tag_map(paths, ocr_fixes_path))
 
-def count_reviews(raw_df, tag_map: dict):
-    """Counts reviews and returns a new dataframe with titles
-    as rows and journal review counts as columns."""
+def resolve_tags(review_strings: pd.Series, tag_lookup: pd.Series) -> pd.DataFrame:
+    """Splits a column of review strings into one row per review and resolves
+    each review's journal abbreviation with tag_lookup, a Series indexed by tag.
 
-    books = {}
-    bad_tags = defaultdict(int) # used for identifying common OCR errors
-    for author, title, review_string in zip(raw_df.Author, raw_df.Title, raw_df.Review):
+    Returns a dataframe indexed like review_strings (one row per review) with the
+    columns tag and journal; journal is NaN where the tag could not be resolved."""
 
-        book_id = title + ' || ' + author
-        if book_id not in books:
-            books[book_id] = defaultdict(int)
+    tags = review_strings.dropna().str.strip().str.split(REVIEW_END_PATTERN).explode()
+    tags = tags.str.split('-').str[0].str.strip()
+    return pd.DataFrame({'tag': tags, 'journal': tags.map(tag_lookup)})
 
-        # all reviews end with a page number of format p[number]
-        # this regex checks for that, as well as common OCR errors identified in testing
-        reviews = re.split(r'pi?[A-Z]?[0-9lO!]+ [a-z]?', review_string.strip())
-        reviews = [r.split('-')[0].strip() for r in reviews]
-        for review in reviews:
-            if review in tag_map:
-                books[book_id][tag_map[review]] += 1
-            else:
-                bad_tags[review] += 1
+def count_reviews(raw_df, tag_map: dict, tag_index=None, min_confidence: float = 0.8):
+    """Counts reviews and returns a sparse matrix with titles
+    as rows and journal review counts as columns, along with
+    the book ids and journal titles that label its rows and columns,
+    and a histogram of unresolved tags, most frequent first.
 
-    books_df = pd.DataFrame.from_dict(books, orient='index')
-    books_df = books_df.fillna(0)
-    books_df = books_df.astype(int)
+    raw_df may be a single dataframe or an iterable of dataframes (e.g. batches
+    streamed from reader.iter_batches), which are processed one at a time.
 
-    return books_df
+    If a TagIndex is given, tags missing from tag_map are resolved to their nearest
+    known abbreviation when the match has at least min_confidence."""
 
-def author_compile(books_df):
-    """Compiles book review counts into author-review counts."""
+    if isinstance(raw_df, pd.DataFrame):
+        raw_df = [raw_df]
 
-    books_df['author_name'] = books_df.index.to_series().str.split('\\|\\|').str[1].str.strip()
-    return books_df.groupby('author_name').sum()
+    tag_lookup = pd.Series(tag_map)
 
-def main():
-    """Loads, preprocesses, and saves review data for replication notebooks."""
+    # integer codes for books and journals, in order of first appearance
+    books = {}
+    journals = {}
+    book_codes = []
+    journal_codes = []
+    bad_tags = [] # used for identifying common OCR errors
+    for batch in raw_df:
+
+        batch = batch.reset_index(drop=True)
+        book_ids = batch.Title + ' || ' + batch.Author
+        local_codes, local_books = pd.factorize(book_ids)
+        global_codes = np.array([books.setdefault(b, len(books)) for b in local_books], dtype=np.int64)
+
+        # rows missing a title or an author have no book id (code -1) and are skipped
+        resolved = resolve_tags(batch.Review[local_codes >= 0], tag_lookup)
+        if tag_index is not None:
+            # fuzzy matches are looked up once per distinct unresolved tag
+            missing = resolved.journal.isna()
+            matches = tag_index.resolve(resolved.loc[missing, 'tag'].unique(), min_confidence)
+            resolved.loc[missing, 'journal'] = resolved.loc[missing, 'tag'].map(
+                {tag: match.title for tag, match in matches.items()})
+        bad_tags.append(resolved.loc[resolved.journal.isna(), 'tag'].value_counts())
+        resolved = resolved[resolved.journal.notna()]
+
+        local_journal_codes, local_journals = pd.factorize(resolved.journal)
+        global_journal_codes = np.array(
+            [journals.setdefault(j, len(journals)) for j in local_journals], dtype=np.int64)
+
+        # the index of resolved points back at the row of the batch each review came from
+        book_codes.append(global_codes[local_codes[resolved.index.to_numpy()]])
+        journal_codes.append(global_journal_codes[local_journal_codes])
+
+    book_codes = np.concatenate(book_codes + [np.empty(0, dtype=np.int64)])
+    journal_codes = np.concatenate(journal_codes + [np.empty(0, dtype=np.int64)])
+
+    # duplicate (book, journal) pairs are summed when converting to CSR
+    counts = sparse.coo_matrix(
+        (np.ones(len(book_codes), dtype=np.int32), (book_codes, journal_codes)),
+        shape=(len(books), len(journals))
+    ).tocsr()
+
+    bad_tags = pd.concat(bad_tags + [pd.Series(dtype=np.int64)]).groupby(level=0).sum()
+    bad_tags = bad_tags.sort_values(ascending=False)
+
+    return counts, pd.Index(books), pd.Index(journals), bad_tags
+
+def author_compile(counts, books: pd.Index):
+    """Compiles book review counts into author-review counts. Returns a sparse
+    matrix with authors as rows, along with the (sorted) author names."""
+
+    author_names = books.to_series().str.split('\\|\\|').str[1].str.strip()
+    codes, authors = pd.factorize(author_names, sort=True)
+
+    # books with no parseable author (code -1) are dropped, as groupby would
+    keep = codes >= 0
+    membership = sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=counts.dtype), (codes[keep], np.flatnonzero(keep))),
+        shape=(len(authors), len(books))
+    )
+    return membership @ counts, pd.Index(authors)
+
+def save_counts(dest_path: str, counts, rows: pd.Index, columns: pd.Index):
+    """Saves a sparse count matrix to dest_path.npz, with its row and column
+    labels in dest_path.rows.tsv and dest_path.columns.tsv."""
+
+    sparse.save_npz(dest_path + '.npz', counts)
+    rows.to_series().to_csv(dest_path + '.rows.tsv', sep='\t', index=False, header=False)
+    columns.to_series().to_csv(dest_path + '.columns.tsv', sep='\t', index=False, header=False)
+
+def load_counts(path: str):
+    """Loads a matrix saved by save_counts. Returns the matrix and its row and column labels."""
+
+    counts = sparse.load_npz(path + '.npz').tocsr()
+    rows = pd.Index(pd.read_csv(path + '.rows.tsv', sep='\t', header=None, keep_default_na=False)[0])
+    columns = pd.Index(pd.read_csv(path + '.columns.tsv', sep='\t', header=None, keep_default_na=False)[0])
+    return counts, rows, columns
+
+def main(fuzzy_tags: bool = False):
+    """Loads, preprocesses, and saves review data for replication notebooks.
+
+    :param bool fuzzy_tags: resolve unknown tags to their nearest known abbreviation
+    """
 
-    tag_paths = [
-        'tags/1965-1985.tsv',
-        'tags/2000.tsv'
-    ]
-    ocr_fixes_path = 'tags/OCR_corrections_1965.tsv'
     raw_data_fnames = [
         '1965-1984.csv',
         '1985-1992.csv',
         '1993-1997.csv',
         '1998-2000.csv',
     ]
-    books_dest_path = 'data/processed/book_reviews_full.tsv'
-    authors_dest_path = 'data/processed/author_reviews_full.tsv'
+    books_dest_path = 'data/processed/book_reviews_full'
+    authors_dest_path = 'data/processed/author_reviews_full'
+    bad_tags_dest_path = 'data/processed/bad_tags.tsv'
 
     # load tags
     print('Loading tags.')
-    tag_map = {}
-    for path in tag_paths:
-        tag_map = tag_map | load_tags(path, ocr_fixes_path)
+    tag_map = get_tag_map()
 
     # raw data comes as title-level rows with a single cell for ALL reviews for that title
-    dfs = []
-  
-    for fname in raw_data_fnames:
-
-        print(f'Loading raw review data: {fname}')
-        path = os.path.join('data/raw', fname)
-        df = pd.read_csv(path, encoding='latin-1')
-        df = df[['Author', 'Title', 'Review']]
-        df['Period'] = fname.split('.csv')[0]
-        dfs.append(df)
-    raw_df = pd.concat(dfs, axis=0)
+    def raw_batches():
+        for fname in raw_data_fnames:
+
+            print(f'Loading raw review data: {fname}')
+            path = os.path.join('data/raw', fname)
+            yield from iter_batches(path)
 
     print('Counting book-level reviews.')
-    books_df = count_reviews(raw_df=raw_df, tag_map=tag_map)
-    books_df.to_csv(books_dest_path, sep='\t')
+    tag_index = TagIndex(tag_map) if fuzzy_tags else None
+    book_counts, books, journals, bad_tags = count_reviews(
+        raw_df=raw_batches(), tag_map=tag_map, tag_index=tag_index)
+    save_counts(books_dest_path, book_counts, books, journals)
+    # unresolved tags, most frequent first, as candidates for OCR_corrections
+    bad_tags.rename_axis('tag').rename('count').to_csv(bad_tags_dest_path, sep='\t')
 
     print('Compiling author-level reviews.')
     # TO DO: fix this so that it correctly joins dates
-    author_compile(books_df).to_csv(authors_dest_path, sep='\t')
+    author_counts, authors = author_compile(book_counts, books)
+    save_counts(authors_dest_path, author_counts, authors, journals)
 
 if __name__ == '__main__':
 
-    main()
+    arg_parser = argparse.ArgumentParser(description='Count BRI reviews by book and author.')
+    arg_parser.add_argument('--fuzzy-tags', action='store_true',
+        help='resolve unknown journal tags to their nearest known abbreviation')
+    args = arg_parser.parse_args()
+
+    main(fuzzy_tags=args.fuzzy_tags)
@@ -0,0 +1,156 @@
+"""
+On-disk cache of parsed review strings, used to avoid re-running the tagger on review
+cells that were already parsed by the same model.
+
+Entries are keyed on a hash of the normalized review string together with a fingerprint
+of the model file, so retraining the tagger never returns stale parses.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from typing import List, Optional
+
+def file_fingerprint(path: str, block_size: int = 1 << 20) -> str:
+    """Returns the sha1 hex digest of a file's contents."""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def normalize(review_string: str) -> str:
+    """Collapses runs of whitespace, which the review tokenizer ignores anyway."""
+
+    return ' '.join(review_string.split())
+
+class ParseCache:
+    """
+    A size-bounded, content-addressed store of parsed reviews backed by sqlite.
+
+    When the cache grows past max_entries items, the least recently used
+    entries are evicted. Hit and miss counts are kept for reporting.
+
+    Several worker processes may share one cache file. Lookups are plain reads, which
+    never take the write lock (the database is in WAL mode, so they don't wait on
+    writers either). New parses and the last_used times of hits are buffered in memory
+    and written by commit in one short transaction, which also keeps the entry count,
+    stored in the database so that every process sees the same one.
+    """
+
+    def __init__(self, path: str, model_fingerprint: str, max_entries: int = 1000000,
+        commit_every: int = 1000):
+
+        self.path = path
+        self.model_fingerprint = model_fingerprint
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = {}         # key -> serialized reviews, not yet written
+        self._touched = set()   # keys of hits whose last_used is not yet updated
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # transactions are opened explicitly, and only to write
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS parses '
+            '(key TEXT PRIMARY KEY, reviews TEXT NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS parses_last_used ON parses (last_used)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) SELECT 'entries', COUNT(*) FROM parses"
+        )
+        self.conn.execute('COMMIT')
+
+    def key(self, review_string: str) -> str:
+
+        text = self.model_fingerprint + '\x00' + normalize(review_string)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, review_string: str) -> Optional[List[dict]]:
+        """Returns the cached list of review dicts, or None on a miss."""
+
+        key = self.key(review_string)
+        if key in self._puts:
+            self.hits += 1
+            return json.loads(self._puts[key])
+        row = self.conn.execute('SELECT reviews FROM parses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched.add(key)
+        return json.loads(row[0])
+
+    def put(self, review_string: str, reviews: List[dict]):
+        """Buffers a parse; it is written at the next commit."""
+
+        self._puts[self.key(review_string)] = json.dumps(reviews)
+        if len(self._puts) + len(self._touched) >= self.commit_every:
+            self.commit()
+
+    def _size(self) -> int:
+
+        return self.conn.execute("SELECT value FROM meta WHERE name = 'entries'").fetchone()[0]
+
+    def _evict(self, size: int) -> int:
+
+        # evict down to 90% of capacity so that eviction doesn't run on every insert
+        excess = size - int(self.max_entries * 0.9)
+        cursor = self.conn.execute(
+            'DELETE FROM parses WHERE key IN '
+            '(SELECT key FROM parses ORDER BY last_used LIMIT ?)',
+            (excess,)
+        )
+        return size - cursor.rowcount
+
+    def commit(self):
+        """Writes buffered parses and last_used times in one transaction."""
+
+        if not self._puts and not self._touched:
+            return
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('UPDATE parses SET last_used = ? WHERE key = ?',
+                [(now, key) for key in self._touched])
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO parses (key, reviews, last_used) VALUES (?, ?, ?)',
+                [(key, reviews, now) for key, reviews in self._puts.items()]
+            )
+            size = self._size() + self.conn.total_changes - before
+            if size > self.max_entries:
+                size = self._evict(size)
+            self.conn.execute("UPDATE meta SET value = ? WHERE name = 'entries'", (size,))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self._puts.clear()
+        self._touched.clear()
+
+    def close(self):
+
+        self.commit()
+        self.conn.close()
+
+    def stats(self) -> dict:
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': self._size(),
+        }
@@ -1,23 +1,41 @@
 
-from dataclasses import dataclass, field
+import os
+import csv
+import json
+import mmap
+from array import array
 from typing import List
 
+import numpy as np
+import pandas as pd
 from flair.models import SequenceTagger
 from flair.data import Sentence
 
 from .tokenizer import ExtractTokenizer
 
-@dataclass
+# the tokenizer stands in [newline] for \n, and flair measures a span's end from its token text
+NEWLINE_EXTRA = len('[newline]') - len('\n')
+
 class Entry:
     """
     Class for representing an entry extracted from raw OCR of the Book Review Index.
+
+    An Entry holds no strings of its own. It keeps a reference to the text it was
+    extracted from, plus the offsets and tags of its spans, and slices field values
+    out of that text on request. Millions of entries can then sit in memory without
+    copying the volume they came from.
     """
-    full_string: str = ''
-    parsed_author: List = field(default_factory=lambda: [])
-    parsed_title: List = field(default_factory=lambda: [])
-    reviews: List = field(default_factory=lambda: [])
-    start_pos: int = None
-    end_pos: int = None
+
+    __slots__ = ('source', 'offset', 'start_pos', 'end_pos', 'tags', 'bounds')
+
+    def __init__(self, source: str, offset: int = 0, start_pos: int = None, end_pos: int = None):
+
+        self.source = source        # text the entry was extracted from
+        self.offset = offset        # position of source[0] within the full text
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.tags = ''              # one character per span: A, T or R
+        self.bounds = array('q')    # start and end position of each span, interleaved
 
     # To do: infer header from full_string and review position
     # def bad_header(self):
@@ -25,15 +43,66 @@ class Entry:
     #     ans = self.header_string.replace(' ', '') == (self.parsed_author + self.parsed_title).replace(' ', '')
     #     return not ans
 
-    def add_by_tag(self, tag: str, value: str):
-        if tag == 'A':
-            self.parsed_author.append(value)
-        elif tag == 'T':
-            self.parsed_title.append(value)
-        elif tag == 'R':
-            self.reviews.append(value)
+    def add_span(self, tag: str, start: int, end: int):
+        if tag in ('A', 'T', 'R'):
+            self.tags += tag
+            self.bounds.append(start)
+            self.bounds.append(end)
         return
 
+    def has_reviews(self) -> bool:
+        return 'R' in self.tags
+
+    def _slice(self, start: int, end: int) -> str:
+        # an entry that never saw a span runs to the end of the text
+        return self.source[start-self.offset:end-self.offset if end is not None else None]
+
+    def _values(self, tag: str) -> List[str]:
+        bounds = self.bounds
+        return [self._slice(bounds[2*i], bounds[2*i+1]) for i, t in enumerate(self.tags) if t == tag]
+
+    @property
+    def full_string(self) -> str:
+        return self._slice(self.start_pos, self.end_pos)
+
+    @property
+    def parsed_author(self) -> List[str]:
+        return self._values('A')
+
+    @property
+    def parsed_title(self) -> List[str]:
+        return self._values('T')
+
+    @property
+    def reviews(self) -> List[str]:
+        return self._values('R')
+
+def to_frame(entries: List[Entry], with_text: bool = True) -> pd.DataFrame:
+    """
+    Returns a DataFrame with one row per tagged span of the given entries, with the columns
+    entry (index into entries), tag, start_pos and end_pos, plus the span text if with_text.
+    Positions are read straight from each entry's offset buffer.
+    """
+
+    counts = np.fromiter((len(entry.tags) for entry in entries), dtype=np.int64, count=len(entries))
+    bounds = np.concatenate(
+        [np.frombuffer(entry.bounds, dtype=np.int64) for entry in entries]
+        + [np.empty(0, dtype=np.int64)]
+    ).reshape(-1, 2)
+    df = pd.DataFrame({
+        'entry': np.repeat(np.arange(len(entries)), counts),
+        'tag': list(''.join(entry.tags for entry in entries)),
+        'start_pos': bounds[:, 0],
+        'end_pos': bounds[:, 1],
+    })
+    if with_text:
+        df['text'] = [
+            entry._slice(start, end)
+            for entry in entries
+            for start, end in zip(entry.bounds[::2], entry.bounds[1::2])
+        ]
+    return df
+
 class Extractor:
     """
     Main class used for extracting individual fields from the raw OCR text of
@@ -52,58 +121,316 @@ class Extractor:
         self.tokenizer = tokenizer
         self.chunk_size = chunk_size
 
+    @classmethod
+    def from_path(cls, model_path: str, chunk_size: int = 10000):
+        """
+        :param str model_path: path to a flair checkpoint, or to a quantized export
+            made by extract/train/export.py
+        :param int chunk_size: number of characters tagged at a time
+        """
+
+        from .modelio import load_tagger
+        return cls(load_tagger(model_path), ExtractTokenizer(), chunk_size=chunk_size)
+
     def extract(self, text: str, verbose: bool = False):
         """
         :param str text: input text from which to extract fields
         :param bool verbose: whether to give progress updates
         """
 
-        chunk_start = 0
-        total = len(text)
-        final = False
+        return list(self._iter_entries(_TextSource(text), verbose=verbose))
+
+    def extract_parallel(self, text: str, overlap: int = 2000, mini_batch_size: int = 8,
+        verbose: bool = False):
+        """
+        Alternative to extract that does not wait on the previous chunk to decide where the next
+        one starts. The text is split at newlines into windows of chunk_size characters that
+        overlap by roughly `overlap` characters, the windows are tagged in batched predict
+        calls, and the entries in each overlap are reconciled at an entry boundary that both
+        neighbouring windows agree on.
+
+        :param str text: input text from which to extract fields
+        :param int overlap: number of characters shared by neighbouring windows; should
+            comfortably exceed the length of two entries
+        :param int mini_batch_size: number of windows per call to predict
+        :param bool verbose: whether to give progress updates
+        """
+
+        if not 0 < overlap < self.chunk_size:
+            raise ValueError('overlap must be positive and smaller than chunk_size')
+
+        windows = _overlapping_windows(text, self.chunk_size, overlap)
+        kept = []       # entries of the previous window that are not yet settled
         entries = []
 
-        while not final:
-
-            chunk_end = chunk_start + self.chunk_size
-            if chunk_end > total:
-                chunk = text[chunk_start:]
-                final = True
-            else:
-                chunk = text[chunk_start:chunk_end]
-            sentence = Sentence(
-                chunk,
-                use_tokenizer=self.tokenizer,
-            )
-            self.model.predict(sentence)
-            current_entry = Entry(start_pos=chunk_start)
-            for span in sentence.get_spans():
-
-                for label in span.labels:
-
-                    if current_entry.reviews and (label.value == 'T' or label.value == 'A'):
-
-                        current_entry.full_string = text[current_entry.start_pos:current_entry.end_pos]
-                        entries.append(current_entry)
-                        current_entry = Entry(start_pos=current_entry.end_pos)
-                        current_entry.add_by_tag(label.value, span.text)
-                        current_entry.end_pos = chunk_start + span.end_pos # end pos is indexed within chunk, not within full text
-
-                    else:
-                        current_entry.add_by_tag(label.value, span.text)
-                        current_entry.end_pos = chunk_start + span.end_pos
-
-            if not final:
-                chunk_start = entries[-2].end_pos 
-                entries = entries[:-1]              # remove the last book, which becomes the beginning of the next chunk
-                                                    # we do this because we can't be sure it is a complete entry
-            else:
-                current_entry.full_string = text[current_entry.start_pos:current_entry.end_pos]
-                entries.append(current_entry)
+        for batch_start in range(0, len(windows), mini_batch_size):
+
+            batch = windows[batch_start:batch_start+mini_batch_size]
+            sentences = [
+                Sentence(text[start:end], use_tokenizer=self.tokenizer)
+                for start, end in batch
+            ]
+            self.model.predict(sentences, mini_batch_size=mini_batch_size)
+
+            for (start, end), sentence in zip(batch, sentences):
+
+                chunk = text[start:end]
+                window_entries, current_entry = self._group_spans(sentence, start, text, 0)
+                if end == len(text):
+                    window_entries.append(current_entry)
+                else:
+                    if len(window_entries) < 2:
+                        raise ValueError(
+                            f'Fewer than two complete entries found in the chunk at position {start}. '
+                            'Try a larger chunk_size.'
+                        )
+                    # as in extract, the last finalized entry may be cut off by the window
+                    window_entries = window_entries[:-1]
+
+                # only the first window's entries start at the start of the text; any later
+                # window must be reconciled with the one before it
+                if start == 0:
+                    kept = window_entries
+                    continue
+                settled, kept = _reconcile(kept, window_entries, start)
+                entries.extend(settled)
+
             if verbose:
-                percent_complete = round(chunk_start / total, 5) * 100
+                percent_complete = round(batch[-1][1] / len(text), 5) * 100
                 print(f'Extracted {len(entries)} books. {percent_complete}% of text parsed.')
 
+        entries.extend(kept)
         return entries
 
+    def iter_extract_file(self, path: str, encoding: str = 'utf-8', verbose: bool = False):
+        """
+        Generator version of extract that reads an OCR volume from disk through mmap and
+        yields each Entry as soon as its chunk is finalized, so memory use is bounded by
+        the chunk size rather than by the size of the volume.
+
+        Entry positions are character offsets into the decoded file, as with extract. Bytes
+        that are not valid in the encoding each count as one character, as when the file is
+        read with errors='surrogateescape'.
+
+        :param str path: path to a text file of raw OCR
+        :param str encoding: encoding of the file
+        :param bool verbose: whether to give progress updates
+        """
+
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from self._iter_entries(_MappedSource(mm, encoding), verbose=verbose)
+
+    def extract_file(self, path: str, dest_path: str, encoding: str = 'utf-8', verbose: bool = False):
+        """
+        Extracts entries from the OCR volume at path and writes them to a .tsv file at
+        dest_path as they are produced. Returns the number of entries written.
+        """
+
+        count = 0
+        # bytes that didn't decode are written as ?
+        with open(dest_path, 'w', newline='', encoding='utf-8', errors='replace') as out:
+            writer = csv.writer(out, delimiter='\t')
+            writer.writerow(['start_pos', 'end_pos', 'author', 'title', 'reviews', 'full_string'])
+            for entry in self.iter_extract_file(path, encoding=encoding, verbose=verbose):
+                writer.writerow([
+                    entry.start_pos,
+                    entry.end_pos,
+                    ' '.join(entry.parsed_author),
+                    ' '.join(entry.parsed_title),
+                    json.dumps(entry.reviews),
+                    entry.full_string,
+                ])
+                count += 1
+
+        return count
+
+    def _iter_entries(self, source, verbose: bool = False):
+        """
+        Core extraction loop shared by extract and iter_extract_file. Each chunk is tagged,
+        and every entry but the last one is yielded; the last entry becomes the beginning
+        of the next chunk, because we can't be sure it is complete.
+        """
+
+        chunk_start = 0     # position of the chunk in characters
+        source_start = 0    # position of the chunk in the units of the source
+        count = 0
+
+        while True:
+
+            chunk, final = source.read(source_start, self.chunk_size)
+            entries, current_entry = self._predict_chunk(
+                chunk, chunk_start, *source.entry_source(chunk, chunk_start))
+
+            if final:
+                entries.append(current_entry)
+                count += len(entries)
+                yield from entries
+                if verbose:
+                    print(f'Extracted {count} books. 100.0% of text parsed.')
+                return
+
+            if len(entries) < 2:
+                raise ValueError(
+                    f'Fewer than two complete entries found in the chunk at position {chunk_start}. '
+                    'Try a larger chunk_size.'
+                )
+            entries = entries[:-1]
+            count += len(entries)
+            yield from entries
+
+            consumed = entries[-1].end_pos - chunk_start
+            source_start += source.advance(chunk, consumed)
+            chunk_start += consumed
+            if verbose:
+                percent_complete = round(source_start / source.total, 5) * 100
+                print(f'Extracted {count} books. {percent_complete}% of text parsed.')
+
+    def _predict_chunk(self, chunk: str, chunk_start: int, source: str, offset: int):
+        """Tags a single chunk and groups its spans into entries."""
+
+        sentence = Sentence(
+            chunk,
+            use_tokenizer=self.tokenizer,
+        )
+        self.model.predict(sentence)
+        return self._group_spans(sentence, chunk_start, source, offset)
+
+    def _group_spans(self, sentence: Sentence, chunk_start: int, source: str, offset: int):
+        """
+        Groups the spans of a tagged chunk into entries. Returns the list of finalized
+        entries and the entry that was still open at the end of the chunk.
+
+        source and offset are the text the entries will slice their fields from and its
+        position within the full text; source must contain the whole chunk.
+        """
+
+        entries = []
+        current_entry = Entry(source, offset, start_pos=chunk_start)
+        for span in sentence.get_spans():
+
+            for label in span.labels:
+
+                # positions of spans are indexed within chunk, not within full text
+                start = chunk_start + span.start_pos
+                end = chunk_start + span.end_pos
+                if span.tokens[-1].text == '[newline]':
+                    end -= NEWLINE_EXTRA
+
+                if current_entry.has_reviews() and (label.value == 'T' or label.value == 'A'):
+
+                    entries.append(current_entry)
+                    current_entry = Entry(source, offset, start_pos=current_entry.end_pos)
+
+                current_entry.add_span(label.value, start, end)
+                current_entry.end_pos = end
+
+        return entries, current_entry
+
+def _overlapping_windows(text: str, size: int, overlap: int) -> List[tuple]:
+    """
+    Returns (start, end) pairs of windows of at most `size` characters covering text.
+    Every window after the first starts just after a newline, about `overlap`
+    characters before the end of the previous window.
+    """
+
+    windows = []
+    start = 0
+    total = len(text)
+    while True:
+        end = min(start + size, total)
+        windows.append((start, end))
+        if end == total:
+            return windows
+        target = end - overlap
+        next_start = text.rfind('\n', start + 1, target) + 1
+        if next_start <= start:
+            next_start = target
+        start = next_start
+
+def _reconcile(kept: List[Entry], window_entries: List[Entry], window_start: int):
+    """
+    Joins the entries of two overlapping windows. We look for the first entry of the new
+    window that starts at an entry boundary of the kept entries. Everything before that
+    boundary is settled from the earlier window, and everything from it on is taken from the
+    new one. The first entry of a window usually starts wherever the window happened to start,
+    so it only counts if it falls on a boundary too.
+
+    Returns the settled entries and the entries that remain open to the next window.
+    """
+
+    boundaries = {entry.start_pos: i for i, entry in enumerate(kept)}
+    boundaries[kept[-1].end_pos] = len(kept)
+    for j, entry in enumerate(window_entries):
+        if entry.start_pos in boundaries:
+            return kept[:boundaries[entry.start_pos]], window_entries[j:]
+
+    raise ValueError(
+        f'Could not reconcile the window starting at {window_start}. Try a larger overlap.'
+    )
+
+class _TextSource:
+    """An in-memory text, read in chunks of characters."""
+
+    def __init__(self, text: str):
+
+        self.text = text
+        self.total = len(text)
+
+    def read(self, start: int, size: int):
+
+        end = start + size
+        if end > self.total:
+            return self.text[start:], True
+        return self.text[start:end], False
+
+    def advance(self, chunk: str, consumed: int) -> int:
+
+        return consumed
+
+    def entry_source(self, chunk: str, chunk_start: int):
+
+        # entries slice the full text, so no chunk has to be kept alive
+        return self.text, 0
+
+class _MappedSource:
+    """
+    A memory-mapped file, read in chunks of bytes and decoded one chunk at a time.
+
+    Bytes that are not valid in the encoding are decoded with surrogateescape, one
+    character per byte, so that every chunk encodes back to exactly the bytes it was
+    read from and the byte position never drifts from the character position.
+    """
+
+    def __init__(self, mm: mmap.mmap, encoding: str):
+
+        self.mm = mm
+        self.encoding = encoding
+        self.total = len(mm)
+
+    def read(self, start: int, size: int):
+
+        end = start + size
+        final = end > self.total
+        data = self.mm[start:end]
+        if not final:
+            # a multi-byte character may straddle the end of the chunk; leave it for the next one
+            for cut in range(4):
+                try:
+                    return data[:len(data)-cut].decode(self.encoding), False
+                except UnicodeDecodeError:
+                    continue
+        return data.decode(self.encoding, errors='surrogateescape'), final
+
+    def advance(self, chunk: str, consumed: int) -> int:
+
+        # number of bytes taken up by the first `consumed` characters of the chunk
+        if chunk.isascii():
+            return consumed
+        return len(chunk[:consumed].encode(self.encoding, errors='surrogateescape'))
+
+    def entry_source(self, chunk: str, chunk_start: int):
 
+        return chunk, chunk_start
@@ -0,0 +1,180 @@
+"""
+Per-stage timing for the preprocessing pipeline.
+
+StageMetrics records, for each named stage (reading the spreadsheets, tokenizing, building
+Sentences, predicting, decoding spans, writing output...), how many times it ran, its total
+time and a histogram of its latencies, from which percentiles are estimated. Histograms have
+four buckets per doubling of latency, so percentiles are accurate to within about 20%, and
+metrics from different worker processes can be merged exactly by adding up their buckets.
+
+Metrics can be written as JSON, or as a Prometheus text file of summaries.
+"""
+import json
+import math
+import time
+from contextlib import contextmanager
+
+# bucket k holds latencies in (2**((k-1)/4), 2**(k/4)] microseconds
+BUCKETS_PER_DOUBLING = 4
+PERCENTILES = (50, 90, 99)
+
+def _bucket(seconds: float) -> int:
+
+    microseconds = seconds * 1e6
+    if microseconds <= 1:
+        return 0
+    return math.ceil(math.log2(microseconds) * BUCKETS_PER_DOUBLING)
+
+def _bucket_upper(bucket: int) -> float:
+    """Upper bound of a bucket, in seconds."""
+
+    return 2 ** (bucket / BUCKETS_PER_DOUBLING) / 1e6
+
+class StageMetrics:
+    """
+    Cumulative time, call counts and latency histograms for named stages.
+    """
+
+    def __init__(self):
+
+        self.stages = {}
+
+    def _stage(self, name: str) -> dict:
+
+        if name not in self.stages:
+            self.stages[name] = {'count': 0, 'items': 0, 'seconds': 0.0, 'max': 0.0, 'buckets': {}}
+        return self.stages[name]
+
+    def record(self, name: str, seconds: float, items: int = 1):
+        """
+        Records one call of a stage that took seconds.
+
+        :param str name: name of the stage
+        :param float seconds: time the call took
+        :param int items: number of items (rows, sentences...) the call handled
+        """
+
+        stage = self._stage(name)
+        stage['count'] += 1
+        stage['items'] += items
+        stage['seconds'] += seconds
+        stage['max'] = max(stage['max'], seconds)
+        bucket = _bucket(seconds)
+        stage['buckets'][bucket] = stage['buckets'].get(bucket, 0) + 1
+
+    @contextmanager
+    def time(self, name: str, items: int = 1):
+        """Context manager that records the time spent inside it as one call of a stage."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, items)
+
+    def timed_iter(self, name: str, iterable):
+        """Yields from iterable, recording the time taken to produce each item as a stage."""
+
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def state(self) -> dict:
+        """Returns the raw counts, in a picklable form that merge accepts."""
+
+        return {name: dict(stage, buckets=dict(stage['buckets'])) for name, stage in self.stages.items()}
+
+    def reset(self):
+
+        self.stages = {}
+
+    def merge(self, state: dict):
+        """Adds the counts from another StageMetrics' state, e.g. one returned by a worker."""
+
+        for name, other in state.items():
+            stage = self._stage(name)
+            stage['count'] += other['count']
+            stage['items'] += other['items']
+            stage['seconds'] += other['seconds']
+            stage['max'] = max(stage['max'], other['max'])
+            for bucket, count in other['buckets'].items():
+                bucket = int(bucket)
+                stage['buckets'][bucket] = stage['buckets'].get(bucket, 0) + count
+
+    def percentile(self, name: str, q: float) -> float:
+        """Estimated q-th percentile of the latency of a stage, in seconds."""
+
+        stage = self.stages[name]
+        rank = q / 100 * stage['count']
+        seen = 0
+        for bucket in sorted(stage['buckets']):
+            seen += stage['buckets'][bucket]
+            if seen >= rank:
+                return min(_bucket_upper(bucket), stage['max'])
+        return stage['max']
+
+    def summary(self) -> dict:
+        """Returns a dict with the count, total, mean and percentile latencies of each stage."""
+
+        summary = {}
+        for name, stage in self.stages.items():
+            summary[name] = {
+                'count': stage['count'],
+                'items': stage['items'],
+                'total_seconds': stage['seconds'],
+                'mean_seconds': stage['seconds'] / stage['count'] if stage['count'] else 0.0,
+                'max_seconds': stage['max'],
+            }
+            for q in PERCENTILES:
+                summary[name][f'p{q}_seconds'] = self.percentile(name, q)
+        return summary
+
+    def to_json(self, path: str):
+
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_prometheus(self, path: str, prefix: str = 'bri_stage'):
+        """Writes each stage as a Prometheus summary, labelled by stage name."""
+
+        lines = [
+            f'# HELP {prefix}_seconds Latency of each pipeline stage.',
+            f'# TYPE {prefix}_seconds summary',
+        ]
+        for name, stage in self.summary().items():
+            for q in PERCENTILES:
+                lines.append(f'{prefix}_seconds{{stage="{name}",quantile="{q / 100}"}} {stage[f"p{q}_seconds"]}')
+            lines.append(f'{prefix}_seconds_sum{{stage="{name}"}} {stage["total_seconds"]}')
+            lines.append(f'{prefix}_seconds_count{{stage="{name}"}} {stage["count"]}')
+        lines.append(f'# HELP {prefix}_items_total Items handled by each pipeline stage.')
+        lines.append(f'# TYPE {prefix}_items_total counter')
+        for name, stage in self.summary().items():
+            lines.append(f'{prefix}_items_total{{stage="{name}"}} {stage["items"]}')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def save(self, path: str):
+        """Writes Prometheus text if path ends with .prom, and JSON otherwise."""
+
+        if path.endswith('.prom'):
+            self.to_prometheus(path)
+        else:
+            self.to_json(path)
+
+    def report(self) -> str:
+        """A table of the stages, slowest in total first."""
+
+        rows = [f'{"stage":<12}{"count":>10}{"total s":>12}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}']
+        summary = self.summary()
+        for name in sorted(summary, key=lambda n: -summary[n]['total_seconds']):
+            s = summary[name]
+            rows.append(f'{name:<12}{s["count"]:>10}{s["total_seconds"]:>12.2f}'
+                f'{1000 * s["mean_seconds"]:>10.2f}{1000 * s["p50_seconds"]:>10.2f}'
+                f'{1000 * s["p90_seconds"]:>10.2f}{1000 * s["p99_seconds"]:>10.2f}')
+        return '\n'.join(rows)
@@ -0,0 +1,62 @@
+"""
+Loading and CPU-oriented export of the flair taggers used by ReviewParser and Extractor.
+
+A tagger exported with save_quantized has its LSTMs and linear layers (including those of
+the character language model inside its FlairEmbeddings) dynamically quantized to int8,
+which cuts per-sentence latency on CPU-only hosts. load_tagger loads either kind of file,
+telling them apart by the QUANTIZED_SUFFIX of the file name.
+"""
+import inspect
+
+import torch
+from flair.models import SequenceTagger
+
+QUANTIZED_SUFFIX = '.int8.pt'
+EXPORT_FORMAT = 'bri-tagger-int8'
+
+class QuantizedLSTM(torch.nn.quantized.dynamic.LSTM):
+    """
+    Dynamically quantized LSTM that tolerates flatten_parameters, which flair's
+    language model calls before every forward pass.
+    """
+
+    def flatten_parameters(self):
+        pass
+
+def quantize_tagger(tagger: SequenceTagger) -> SequenceTagger:
+    """Returns a copy of tagger with its LSTM and linear layers dynamically quantized to int8."""
+
+    tagger.eval()
+    quantized = torch.quantization.quantize_dynamic(
+        tagger,
+        {torch.nn.LSTM, torch.nn.Linear},
+        dtype=torch.qint8,
+    )
+    for module in quantized.modules():
+        if type(module) is torch.nn.quantized.dynamic.LSTM:
+            module.__class__ = QuantizedLSTM
+    return quantized
+
+def save_quantized(tagger: SequenceTagger, path: str):
+    """Saves a quantized tagger whole, since flair's state-dict loader can't rebuild it."""
+
+    if not path.endswith(QUANTIZED_SUFFIX):
+        raise ValueError(f'Quantized taggers must be saved with the suffix {QUANTIZED_SUFFIX}')
+    torch.save({'format': EXPORT_FORMAT, 'model': tagger}, path)
+
+def load_tagger(path: str) -> SequenceTagger:
+    """Loads a flair checkpoint, or a quantized export if path ends with QUANTIZED_SUFFIX."""
+
+    if not path.endswith(QUANTIZED_SUFFIX):
+        return SequenceTagger.load(path)
+
+    kwargs = {'map_location': 'cpu'}
+    # the export is a pickled module rather than plain weights
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        kwargs['weights_only'] = False
+    saved = torch.load(path, **kwargs)
+    if not isinstance(saved, dict) or saved.get('format') != EXPORT_FORMAT:
+        raise ValueError(f'{path} is not a quantized tagger export')
+    tagger = saved['model']
+    tagger.eval()
+    return tagger
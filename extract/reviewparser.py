@@ -21,15 +21,69 @@ expression designed to accomodate the most common OCR errors. An alternative, pr
 is a custom LSTM sequence tagger that makes use of custom Flair character embeddings.
 """
 import re
+from typing import TYPE_CHECKING, List, Union
 
-from flair.models import SequenceTagger
-from flair.data import Sentence
+from .cache import ParseCache, file_fingerprint
+from .metrics import StageMetrics
+from .tagindex import TagIndex
+from .tokenizer import review_tokens
+
+if TYPE_CHECKING:
+    from flair.data import Sentence
+
+# A single well-formed review, e.g. "Choice - v35 - D '97 - p690 - [51-250]".
+# Field values keep the prefixes the review tokenizer keeps ("v35", "p690"), and the
+# year loses its apostrophe, as it does in tagger output. The apostrophe is optional,
+# since the original text of a tokenized sentence has a space in its place.
+# The journal may contain dashes only between two non-space characters ("H-Net"), and no
+# digits, so it can never run across a " - " separator or swallow a volume, date or page.
+REVIEW_PATTERN = re.compile(r"""
+    (?P<J>[^\[\]'0-9\s-](?:[^\[\]'0-9\s-]|\s(?!\s*-)|(?<=\S)-(?=[^\s-]))*?)\s*-\s*
+    (?:(?P<V>v[0-9]+)\s*-\s*)?
+    (?:(?P<M>Ja|F|Mr|Ap|My|Je|Jl|Ag|S|O|N|D|Spr|Sum|Fall|Fal|Win|W)
+        (?:\s+(?P<D>[0-9]{1,2}))?\s*)?
+    '?(?P<Y>[0-9]{2})\s*-\s*
+    (?P<P>p[0-9]+[a-z]?|ONL)
+    (?:\s*-?\s*(?P<L>\[[0-9]+[-+]?[0-9]*\+?\]))?
+    \s*(?:-\s*|$)
+""", re.VERBOSE)
+
+# the index covers 1965-2000, so any other two-digit year means the match went wrong
+PLAUSIBLE_YEARS = {f'{y:02d}' for y in list(range(65, 100)) + [0]}
+
+# Anything in a journal that belongs to another field or another review: a dash with
+# space around it, a digit (volumes, days, years and pages all have them), or a month
+# or season on its own.
+INVALID_JOURNAL_PATTERN = re.compile(r"""
+    \s-|-\s|^-|-$|[0-9]|
+    (?:^|\s)(?:Ja|F|Mr|Ap|My|Je|Jl|Ag|S|O|N|D|Spr|Sum|Fall|Fal|Win|W)(?:\s|$)
+""", re.VERBOSE)
+
+class TextSentence:
+    """
+    Lightweight stand-in for a flair Sentence that holds only the raw review string.
+    The regex methods need nothing else, so this lets them run without importing flair
+    and torch. When a tagger is loaded, ReviewParser tokenizes these on demand.
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+
+        self.text = text
+
+    def to_original_text(self) -> str:
+        """Returns the text as flair would rebuild it from the review tokenizer's tokens:
+        the apostrophes the tokenizer drops become spaces, and trailing spaces are lost."""
+
+        return self.text.replace("'", " ").rstrip(" ")
 
 class ReviewParser:
     """
     A parser that provides two separate methods for extracting fields from Index entries.
     If a path to a flair model is provided, it uses a flair SequenceTagger to extract fields.
-    Otherwise, it defaults to a regular expression method.
+    The path may also point to a quantized export of the model (see extract/modelio.py).
+    Otherwise, it defaults to a regular expression method, and flair is never imported.
     In either case, it returns a list of review dicts, where keys are fields.
 
     Guide to fields.
@@ -44,33 +98,148 @@ class ReviewParser:
 
     The SequenceTagger method extracts all fields, whereas the regex method extracts only journals.
 
+    If a cache_path is provided along with a model, tagger output is stored in an on-disk
+    ParseCache and reused for any review string the same model has already parsed.
+
+    If cascade is True, every string is first parsed with a strict regex that extracts all
+    fields. Strings that pass structural validation are returned as-is, and only the rest
+    are sent to the tagger. cascade_counts records how many strings took each path.
+
+    If a TagIndex is provided, every review's J field is resolved to a journal title, which
+    is added under 'journal', along with the confidence of the match under
+    'journal_confidence'. Journals that can't be resolved with at least min_confidence (the
+    threshold data_prep.count_reviews uses by default) are left out.
+
+    Time spent in each stage of parse_batch (regex, cascade, tokenize, sentence, predict,
+    decode, resolve) is recorded in metrics, a StageMetrics. The sentence stage includes
+    the tokenizing done while building each flair Sentence.
+
     """
 
-    def __init__(self, model_path: str = ''):
+    def __init__(self, model_path: str = '', cache_path: str = '', cache_size: int = 1000000,
+        cascade: bool = False, tag_index: TagIndex = None, metrics: StageMetrics = None,
+        min_confidence: float = 0.8):
 
         self.model_path = model_path
+        self.tag_index = tag_index
+        self.min_confidence = min_confidence
+        self.cascade = cascade
+        self.cascade_counts = {'regex': 0, 'tagger': 0}
+        self.metrics = metrics if metrics is not None else StageMetrics()
 
         if model_path:
-            self.tagger = SequenceTagger.load(model_path)
+            from .modelio import load_tagger
+            from .tokenizer import ReviewTokenizer
+            self.tagger = load_tagger(model_path)
+            self.tokenizer = ReviewTokenizer(metrics=self.metrics)
         else:
             self.tagger = None
+            self.tokenizer = None
+
+        if model_path and cache_path:
+            self.cache = ParseCache(cache_path, file_fingerprint(model_path), max_entries=cache_size)
+        else:
+            self.cache = None
 
-    def parse(self, review_sentence_obj: Sentence):
+    def parse(self, review_sentence_obj: Union['Sentence', TextSentence]):
         """
-        Given a flair Sentence object, parses BRI fields and a returns a list of dicts,
-        where each dict is field-value pairs for one review.
+        Given a flair Sentence object (or a TextSentence), parses BRI fields and a returns
+        a list of dicts, where each dict is field-value pairs for one review.
         """
 
         if self.tagger:
-            return self._tagger_parse(review_sentence_obj)
+            if self.cache or self.cascade:
+                return self.parse_batch([review_sentence_obj])[0]
+            return self._resolve_journals(self._tagger_parse(self._as_flair(review_sentence_obj)))
         else:
-            return self._regex_parse(review_sentence_obj)
+            return self._resolve_journals(self._regex_parse(review_sentence_obj))
+
+    def parse_batch(self, review_sentence_objs: List[Union['Sentence', TextSentence]],
+        mini_batch_size: int = 32):
+        """
+        Given a list of flair Sentence objects (or TextSentences), parses BRI fields and
+        returns one list of review dicts per sentence, in the same order as the input.
+
+        Sentences are sorted by length and sent to the tagger in mini-batches of
+        mini_batch_size, which avoids paying the per-call overhead of predict for every row.
+        """
+
+        if not self.tagger:
+            with self.metrics.time('regex', len(review_sentence_objs)):
+                results = [self._regex_parse(sentence) for sentence in review_sentence_objs]
+            return self._resolve_all(results)
 
-    def _tagger_parse(self, review_sentence_obj: Sentence):
+        results = [None] * len(review_sentence_objs)
+        if self.cascade:
+            with self.metrics.time('cascade', len(review_sentence_objs)):
+                for i, sentence in enumerate(review_sentence_objs):
+                    results[i] = self._strict_regex_parse(sentence.to_original_text())
+            passed = sum(result is not None for result in results)
+            self.cascade_counts['regex'] += passed
+            self.cascade_counts['tagger'] += len(results) - passed
+        if self.cache:
+            for i, sentence in enumerate(review_sentence_objs):
+                if results[i] is None:
+                    results[i] = self.cache.get(sentence.to_original_text())
+        pending = [i for i, result in enumerate(results) if result is None]
+
+        # only the strings that actually go to the tagger are tokenized
+        with self.metrics.time('sentence', len(pending)):
+            tagged = {i: self._as_flair(review_sentence_objs[i]) for i in pending}
+
+        # sorting by length keeps padding within each mini-batch to a minimum
+        pending.sort(key=lambda i: len(tagged[i]), reverse=True)
+        for start in range(0, len(pending), mini_batch_size):
+            batch = [tagged[i] for i in pending[start:start+mini_batch_size]]
+            with self.metrics.time('predict', len(batch)):
+                self.tagger.predict(batch, mini_batch_size=mini_batch_size)
+
+        with self.metrics.time('decode', len(pending)):
+            for i in pending:
+                results[i] = self._decode_spans(tagged[i])
+        if self.cache:
+            for i in pending:
+                self.cache.put(review_sentence_objs[i].to_original_text(), results[i])
+            # one short write transaction per batch, taken only after the tagger is done
+            self.cache.commit()
+
+        return self._resolve_all(results)
+
+    def _resolve_all(self, results: List[List[dict]]) -> List[List[dict]]:
+
+        if not self.tag_index:
+            return results
+        with self.metrics.time('resolve', len(results)):
+            return [self._resolve_journals(reviews) for reviews in results]
+
+    def _resolve_journals(self, reviews: List[dict]) -> List[dict]:
+
+        if self.tag_index:
+            for review in reviews:
+                match = self.tag_index.lookup(review['J']) if 'J' in review else None
+                if match is not None and match.confidence >= self.min_confidence:
+                    review['journal'] = match.title
+                    review['journal_confidence'] = match.confidence
+        return reviews
+
+    def _as_flair(self, review_sentence_obj: Union['Sentence', TextSentence]) -> 'Sentence':
+        """Tokenizes a TextSentence into a flair Sentence; flair Sentences pass through."""
+
+        if isinstance(review_sentence_obj, TextSentence):
+            from flair.data import Sentence
+            return Sentence(review_sentence_obj.text, use_tokenizer=self.tokenizer)
+        return review_sentence_obj
+
+    def _tagger_parse(self, review_sentence_obj: 'Sentence'):
+
+        self.tagger.predict(review_sentence_obj)
+        return self._decode_spans(review_sentence_obj)
+
+    def _decode_spans(self, review_sentence_obj: 'Sentence'):
+        """Groups the predicted spans of a tagged sentence into review dicts."""
 
         reviews = []
         current_review = {}
-        self.tagger.predict(review_sentence_obj)
         for span in review_sentence_obj.get_spans('tag'):
 
             for label in span.labels:
@@ -87,7 +256,34 @@ class ReviewParser:
         reviews.append(current_review)
         return reviews
 
-    def _regex_parse(self, review_sentence_obj: Sentence):
+    @staticmethod
+    def _strict_regex_parse(review_string: str):
+        """
+        Parses all fields of a review string with REVIEW_PATTERN. Returns None unless the
+        whole string is consumed by well-formed reviews, each with exactly one journal,
+        a plausible year and a page, in which case the result can be trusted without the tagger.
+        Field values are the tagger's span text, e.g. 'H - Net' and '[51 - 250]'.
+        """
+
+        review_string = review_string.strip()
+        reviews = []
+        pos = 0
+        while pos < len(review_string):
+            match = REVIEW_PATTERN.match(review_string, pos)
+            if not match or match.end() == pos:
+                return None
+            review = {k: v for k, v in match.groupdict().items() if v is not None}
+            if review['Y'] not in PLAUSIBLE_YEARS:
+                return None
+            if INVALID_JOURNAL_PATTERN.search(review['J'].strip()):
+                return None
+            # field text as the tagger's spans give it: tokens joined by single spaces
+            reviews.append({k: ' '.join(token for token, _, _ in review_tokens(v)) for k, v in review.items()})
+            pos = match.end()
+
+        return reviews or None
+
+    def _regex_parse(self, review_sentence_obj: Union['Sentence', TextSentence]):
 
         review_string = review_sentence_obj.to_original_text()
 
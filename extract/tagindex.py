@@ -0,0 +1,165 @@
+"""
+Fuzzy index over BRI journal abbreviations, used to recover journal tags mangled by OCR.
+
+Exact lookups in the tag map miss any abbreviation with an OCR error that nobody has
+added to the corrections spreadsheet by hand. This module resolves such tags to the
+nearest known abbreviation with a symmetric-deletion dictionary: every known tag is
+indexed under all the strings obtained by deleting up to max_edits characters, so any
+tag within max_edits edits of a query shares at least one key with it. The candidates
+are then ranked with an edit distance in which the usual OCR confusions are cheap.
+"""
+from itertools import combinations
+from typing import Dict, List, NamedTuple, Optional
+
+# groups of characters that the OCR commonly confuses with one another
+OCR_CONFUSIONS = [
+    'l1I!i|',
+    'O0oQD',
+    'S5s',
+    'B8',
+    'Z2',
+    'G6',
+    'ce',
+    ',.',
+]
+
+# pairs of character sequences of different lengths that the OCR confuses, e.g. "rn"
+# read as "m"
+OCR_MULTI_CONFUSIONS = [
+    ('rn', 'm'),
+    ('cl', 'd'),
+    ('vv', 'w'),
+    ('ii', 'u'),
+]
+
+# cost of substituting one character for another from the same confusion group, or one
+# sequence for the other in a multi-character confusion
+CONFUSION_COST = 0.25
+
+def _confusion_pairs() -> set:
+
+    pairs = set()
+    for group in OCR_CONFUSIONS:
+        for a in group:
+            for b in group:
+                if a != b:
+                    pairs.add((a, b))
+    return pairs
+
+_CONFUSABLE = _confusion_pairs()
+
+# the confusions above that replace two characters with one, in either direction
+_MULTI_CONFUSABLE = {(long, short) for long, short in OCR_MULTI_CONFUSIONS if len(long) == 2 and len(short) == 1}
+
+def normalize(tag: str) -> str:
+    """Removes spaces, since dropped and inserted spaces are the most common OCR error."""
+
+    return tag.replace(' ', '')
+
+def ocr_distance(a: str, b: str) -> float:
+    """
+    Weighted Damerau-Levenshtein distance between two normalized tags. Insertions,
+    deletions, transpositions and substitutions cost 1, except for substitutions
+    between characters the OCR commonly confuses, and for two-character sequences read
+    as one character ("rn" as "m"), which cost CONFUSION_COST.
+    """
+
+    n, m = len(a), len(b)
+    previous2 = None
+    previous = [float(j) for j in range(m + 1)]
+    for i in range(1, n + 1):
+        current = [float(i)] + [0.0] * m
+        for j in range(1, m + 1):
+            if a[i-1] == b[j-1]:
+                cost = 0.0
+            elif (a[i-1], b[j-1]) in _CONFUSABLE:
+                cost = CONFUSION_COST
+            else:
+                cost = 1.0
+            current[j] = min(
+                previous[j] + 1.0,          # deletion
+                current[j-1] + 1.0,         # insertion
+                previous[j-1] + cost,       # substitution
+            )
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                current[j] = min(current[j], previous2[j-2] + 1.0)   # transposition
+            if i > 1 and (a[i-2:i], b[j-1]) in _MULTI_CONFUSABLE:
+                current[j] = min(current[j], previous2[j-1] + CONFUSION_COST)
+            if j > 1 and (b[j-2:j], a[i-1]) in _MULTI_CONFUSABLE:
+                current[j] = min(current[j], previous[j-2] + CONFUSION_COST)
+        previous2, previous = previous, current
+    return previous[m]
+
+class Match(NamedTuple):
+    title: str          # journal title
+    tag: str            # known abbreviation the query was resolved to
+    distance: float     # weighted edit distance between query and tag
+    confidence: float   # 1 for an exact match, falling towards 0 with distance
+
+class TagIndex:
+    """
+    Symmetric-deletion index over the abbreviations of a tag map (as built by
+    data_prep.load_tags), for resolving unknown tags to their nearest journal.
+    """
+
+    def __init__(self, tag_map: Dict[str, str], max_edits: int = 2):
+
+        self.max_edits = max_edits
+        self.titles = {}
+        self.deletes = {}
+        for tag, title in tag_map.items():
+            key = normalize(tag)
+            if not key or key in self.titles:
+                continue
+            self.titles[key] = title
+            for variant in self._deletes(key):
+                self.deletes.setdefault(variant, []).append(key)
+        self._memo = {}
+
+    def _deletes(self, key: str) -> set:
+        """All strings obtained by deleting up to max_edits characters from key."""
+
+        variants = {key}
+        for n in range(1, min(self.max_edits, len(key) - 1) + 1):
+            for positions in combinations(range(len(key)), n):
+                variants.add(''.join(c for i, c in enumerate(key) if i not in positions))
+        return variants
+
+    def lookup(self, tag: str) -> Optional[Match]:
+        """
+        Returns the closest known abbreviation to tag, or None if no abbreviation
+        is within max_edits edits.
+        """
+
+        if tag in self._memo:
+            return self._memo[tag]
+
+        query = normalize(tag)
+        best = None
+        if query in self.titles:
+            best = Match(self.titles[query], query, 0.0, 1.0)
+        elif query:
+            candidates = set()
+            for variant in self._deletes(query):
+                candidates.update(self.deletes.get(variant, ()))
+            for key in sorted(candidates):
+                distance = ocr_distance(query, key)
+                if distance <= self.max_edits and (best is None or distance < best.distance):
+                    confidence = max(0.0, 1.0 - distance / max(len(query), len(key)))
+                    best = Match(self.titles[key], key, distance, confidence)
+
+        self._memo[tag] = best
+        return best
+
+    def resolve(self, tags: List[str], min_confidence: float = 0.8) -> Dict[str, Match]:
+        """
+        Looks up each tag and returns a dict from tag to Match for the tags that resolved
+        with at least min_confidence.
+        """
+
+        resolved = {}
+        for tag in tags:
+            match = self.lookup(tag)
+            if match is not None and match.confidence >= min_confidence:
+                resolved[tag] = match
+        return resolved
@@ -1,174 +1,131 @@
 """
 Specialized tokenizer classes for parsing the Book Review Index.
+
+The tokenizing itself is done by review_tokens and extract_tokens, which return plain
+(text, start_position, whitespace_after) tuples and don't need flair. ReviewTokenizer
+and ExtractTokenizer wrap them as flair Tokenizers; they are defined the first time
+they are imported, so that importing this module doesn't pull in flair and torch.
+
+The patterns produce exactly the tokens of the character loops they replaced (see
+tests/test_tokenizer.py), but they are not meaningfully faster end to end: most of the time
+goes into building one tuple or Token per token (see benchmarks/tokenizer_bench.py).
 """
-from typing import List
-from flair.data import Tokenizer, Token
+import re
+from typing import List, Tuple
+
+# A token is either a single dash (or newline) or a run of characters that are not
+# separators. The lookahead captures the following character when it is a space, which
+# is exactly when the token has whitespace after it.
+REVIEW_TOKEN_PATTERN = re.compile(r"(-|[^ '\-]+)(?=( ?))")
+EXTRACT_TOKEN_PATTERN = re.compile(r"([\-\n]|[^ \-\n]+)(?=( ?))")
 
-class ReviewTokenizer(Tokenizer):
+def review_tokens(text: str) -> List[Tuple[str, int, bool]]:
     """
-    Custom tokenizer used for review tagger. Splits on spaces and apostrophes, which it removes,
-    as well as on dashes, which it keeps.
+    Splits on spaces and apostrophes, which it removes, as well as on dashes, which it keeps.
+    Returns a list of (text, start_position, whitespace_after) tuples.
     """
 
-    def tokenize(self, text: str) -> List[Token]:
-        return ReviewTokenizer.run_tokenize(text)
+    return [
+        (match[1], match.start(), match[2] == " ")
+        for match in REVIEW_TOKEN_PATTERN.finditer(text)
+    ]
 
-    @staticmethod
-    def run_tokenize(text: str) -> List[Token]:
-        """
-        Primary tokenization method. Splits on spaces and apostrophes, which it removes,
-        as well as on dashes, which it keeps. Returns a list of Flair Token objects.
-        """
-
-        tokens: List[Token] = []
-
-        word = ""
-        index = -1
-        for index, char in enumerate(text):
-
-            if char in " '":
-                if len(word) > 0:
-                    whitespace_after = char == " "
-                    start_position = index - len(word)
-                    tokens.append(
-                        Token(
-                            text=word,
-                            start_position=start_position,
-                            whitespace_after=whitespace_after
-                        )
-                    )
-                word = ""
-            elif char == "-":
-
-                if len(word) > 0:
-                    start_position = index - len(word)
-                    tokens.append(
-                        Token(
-                            text=word,
-                            start_position=start_position,
-                            whitespace_after=False
-                        )
-                    )
-                try:
-                    whitespace_after = text[index+1] == " "
-                except IndexError:
-                    whitespace_after = False
-                tokens.append(
-                    Token(
-                        text="-",
-                        start_position=index,
-                        whitespace_after=whitespace_after
-                    )
-                )
-                word = ""
-            else:
-                word += char
-
-        # increment for last token in sentence if not followed by whitespace
-        index += 1
-        if len(word) > 0:
-            start_position = index - len(word)
-            tokens.append(
-                Token(text=word,
-                start_position=start_position,
-                whitespace_after=False)
-            )
-
-        return tokens
-
-class ExtractTokenizer(Tokenizer):
+def extract_tokens(text: str) -> List[Tuple[str, int, bool]]:
     """
-    Custom tokenizer used for extracting tagged fields from the raw OCR data.
     Splits on spaces, which it removes, as well as on dashes, which it keeps.
     Replaces \n char with [newline], which is treated as a single token.
+    Returns a list of (text, start_position, whitespace_after) tuples.
     """
 
-    def tokenize(self, text: str) -> List[Token]:
-        return ExtractTokenizer.run_tokenize(text)
+    return [
+        ("[newline]" if match[1] == "\n" else match[1], match.start(), match[2] == " ")
+        for match in EXTRACT_TOKEN_PATTERN.finditer(text)
+    ]
+
+def _define_flair_tokenizers():
+
+    from flair.data import Tokenizer, Token
 
-    @staticmethod
-    def run_tokenize(text: str) -> List[Token]:
+    class ReviewTokenizer(Tokenizer):
         """
-        Primary tokenization method. Splits on spaces, which it removes,
-        as well as on dashes, which it keeps. Returns a list of Flair Token objects.
-        Replaces \n char with [newline], which is treated as a single token.
-        Returns a list of Token objects.
+        Custom tokenizer used for review tagger. Splits on spaces and apostrophes, which it removes,
+        as well as on dashes, which it keeps.
         """
 
-        tokens: List[Token] = []
-
-        word = ""
-        index = -1
-        for index, char in enumerate(text):
-
-            if char == ' ':
-                if len(word) > 0:
-                    start_position = index - len(word)
-                    tokens.append(
-                        Token(
-                            text=word,
-                            start_position=start_position,
-                            whitespace_after=True
-                        )
-                    )
-                word = ""
-            elif char == "-":
-
-                if len(word) > 0:
-                    start_position = index - len(word)
-                    tokens.append(
-                        Token(
-                            text=word,
-                            start_position=start_position,
-                            whitespace_after=False
-                        )
-                    )
-                try:
-                    whitespace_after = text[index+1] == " "
-                except IndexError:
-                    whitespace_after = False
-                tokens.append(
-                    Token(
-                        text="-",
-                        start_position=index,
-                        whitespace_after=whitespace_after
-                    )
+        def __init__(self, metrics=None):
+
+            super().__init__()
+            # optional StageMetrics, which records the time spent tokenizing
+            self.metrics = metrics
+
+        def tokenize(self, text: str) -> List[Token]:
+            if self.metrics is None:
+                return ReviewTokenizer.run_tokenize(text)
+            with self.metrics.time('tokenize'):
+                return ReviewTokenizer.run_tokenize(text)
+
+        @staticmethod
+        def run_tokenize(text: str) -> List[Token]:
+            """
+            Primary tokenization method. Splits on spaces and apostrophes, which it removes,
+            as well as on dashes, which it keeps. Returns a list of Flair Token objects.
+            """
+
+            return [
+                Token(
+                    text=match[1],
+                    start_position=match.start(),
+                    whitespace_after=match[2] == " "
                 )
-                word = ""
-            elif char == "\n":
-
-                if len(word) > 0:
-                    start_position = index - len(word)
-                    tokens.append(
-                        Token(
-                            text=word,
-                            start_position=start_position,
-                            whitespace_after=False
-                        )
-                    )
-                try:
-                    whitespace_after = text[index+1] == " "
-                except IndexError:
-                    whitespace_after = False
-                tokens.append(
-                    Token(
-                        text="[newline]",
-                        start_position=index,
-                        whitespace_after=whitespace_after
-                    )
+                for match in REVIEW_TOKEN_PATTERN.finditer(text)
+            ]
+
+    class ExtractTokenizer(Tokenizer):
+        """
+        Custom tokenizer used for extracting tagged fields from the raw OCR data.
+        Splits on spaces, which it removes, as well as on dashes, which it keeps.
+        Replaces \n char with [newline], which is treated as a single token.
+        """
+
+        def __init__(self, metrics=None):
+
+            super().__init__()
+            # optional StageMetrics, which records the time spent tokenizing
+            self.metrics = metrics
+
+        def tokenize(self, text: str) -> List[Token]:
+            if self.metrics is None:
+                return ExtractTokenizer.run_tokenize(text)
+            with self.metrics.time('tokenize'):
+                return ExtractTokenizer.run_tokenize(text)
+
+        @staticmethod
+        def run_tokenize(text: str) -> List[Token]:
+            """
+            Primary tokenization method. Splits on spaces, which it removes,
+            as well as on dashes, which it keeps. Returns a list of Flair Token objects.
+            Replaces \n char with [newline], which is treated as a single token.
+            Returns a list of Token objects.
+            """
+
+            return [
+                Token(
+                    text="[newline]" if match[1] == "\n" else match[1],
+                    start_position=match.start(),
+                    whitespace_after=match[2] == " "
                 )
-                word = ""
-            else:
-                word += char
-
-        # increment for last token in sentence if not followed by whitespace
-        index += 1
-        if len(word) > 0:
-            start_position = index - len(word)
-            tokens.append(
-                Token(text=word,
-                start_position=start_position,
-                whitespace_after=False)
-            )
-
-        return tokens
+                for match in EXTRACT_TOKEN_PATTERN.finditer(text)
+            ]
+
+    for cls in (ReviewTokenizer, ExtractTokenizer):
+        # make the classes picklable under their module-level names
+        cls.__module__ = __name__
+        cls.__qualname__ = cls.__name__
+        globals()[cls.__name__] = cls
+
+def __getattr__(name: str):
+
+    if name in ('ReviewTokenizer', 'ExtractTokenizer'):
+        _define_flair_tokenizers()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
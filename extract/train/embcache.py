@@ -0,0 +1,174 @@
+"""
+On-disk store of precomputed token embeddings, for training taggers on a frozen language model.
+
+The character language model inside FlairEmbeddings is frozen while a tagger trains, so
+the embedding of a given sentence never changes between epochs. precompute runs the
+language model over a corpus once and writes every token's embedding to a float32 .npy
+file, with a JSON index from each sentence's tokenized text to its rows. During training,
+PrecomputedEmbeddings reads the rows back through a memory map, so the store doesn't have
+to fit in memory. Once training is done, restore_embeddings puts the real FlairEmbeddings
+back into the saved models, so that they can tag new text.
+
+The index also records a fingerprint of the language model and corpus files the store was
+computed from, so that a store left over from another model or corpus is rebuilt rather
+than silently reused.
+"""
+import os
+import sys
+import json
+import hashlib
+
+import numpy as np
+import torch
+import flair
+from flair.data import Sentence
+from flair.embeddings import TokenEmbeddings
+from flair.models import SequenceTagger
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from extract.cache import file_fingerprint
+
+def _key(sentence: Sentence) -> str:
+
+    return sentence.to_tokenized_string()
+
+def inputs_fingerprint(*paths: str) -> str:
+    """Returns a single fingerprint of the contents of the given files, in order."""
+
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(file_fingerprint(path).encode())
+    return digest.hexdigest()
+
+def precompute(embeddings: TokenEmbeddings, sentences, store_path: str,
+    mini_batch_size: int = 64, verbose: bool = True, fingerprint: str = ''):
+    """
+    Embeds each sentence once and writes the token embeddings to store_path.npy,
+    with their index in store_path.json.
+
+    :param TokenEmbeddings embeddings: frozen embeddings to precompute, e.g. FlairEmbeddings
+    :param sentences: iterable of flair Sentences, e.g. corpus.get_all_sentences()
+    :param str store_path: path of the store, without extension
+    :param int mini_batch_size: number of sentences embedded at a time
+    :param bool verbose: whether to give progress updates
+    :param str fingerprint: fingerprint of the inputs, from inputs_fingerprint, checked
+        by store_exists
+    """
+
+    # first pass: assign each distinct sentence its rows, so the array can be allocated up front
+    index = {}
+    unique = []
+    total = 0
+    for sentence in sentences:
+        key = _key(sentence)
+        if key not in index:
+            index[key] = (total, len(sentence))
+            unique.append(sentence)
+            total += len(sentence)
+
+    tmp_path = store_path + '.tmp.npy'
+    store = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32, shape=(total, embeddings.embedding_length))
+
+    for i in range(0, len(unique), mini_batch_size):
+        batch = unique[i:i+mini_batch_size]
+        with torch.no_grad():
+            embeddings.embed(batch)
+        for sentence in batch:
+            offset, _ = index[_key(sentence)]
+            vectors = torch.stack([token.get_embedding([embeddings.name]) for token in sentence])
+            store[offset:offset+len(sentence)] = vectors.detach().cpu().numpy()
+            sentence.clear_embeddings()
+        if verbose and (i // mini_batch_size) % 100 == 0:
+            print(f'Embedded {min(i + mini_batch_size, len(unique))} of {len(unique)} sentences.')
+
+    store.flush()
+    del store
+
+    # write to temporary files first, so that an interrupted run never leaves a partial store
+    with open(store_path + '.json.tmp', 'w') as f:
+        json.dump({
+            'name': embeddings.name,
+            'embedding_length': embeddings.embedding_length,
+            'fingerprint': fingerprint,
+            'index': index,
+        }, f)
+    os.replace(tmp_path, store_path + '.npy')
+    os.replace(store_path + '.json.tmp', store_path + '.json')
+
+def store_exists(store_path: str, fingerprint: str = None) -> bool:
+    """
+    Whether a complete store exists at store_path and, if fingerprint is given, was
+    computed from the same inputs.
+    """
+
+    if not (os.path.exists(store_path + '.npy') and os.path.exists(store_path + '.json')):
+        return False
+    if fingerprint is None:
+        return True
+    with open(store_path + '.json') as f:
+        meta = json.load(f)
+    return meta.get('fingerprint') == fingerprint
+
+class PrecomputedEmbeddings(TokenEmbeddings):
+    """
+    Token embeddings read from a store written by precompute. Every sentence embedded
+    must be in the store, i.e. must have been part of the corpus it was computed from.
+    """
+
+    def __init__(self, store_path: str):
+
+        super().__init__()
+        self.store_path = store_path
+        with open(store_path + '.json') as f:
+            meta = json.load(f)
+        self.name = meta['name']
+        self.__embedding_length = meta['embedding_length']
+        self.index = meta['index']
+        self.static_embeddings = True
+        self._store = None
+
+    @property
+    def embedding_length(self) -> int:
+
+        return self.__embedding_length
+
+    @property
+    def store(self) -> np.ndarray:
+
+        # opened lazily so that the memory map is never pickled along with the model
+        if self._store is None:
+            self._store = np.load(self.store_path + '.npy', mmap_mode='r')
+        return self._store
+
+    def _add_embeddings_internal(self, sentences):
+
+        for sentence in sentences:
+            key = _key(sentence)
+            if key not in self.index:
+                raise KeyError(f'Sentence not in embedding store {self.store_path}: {key[:80]}')
+            offset, length = self.index[key]
+            vectors = torch.from_numpy(np.array(self.store[offset:offset+length]))
+            for token, vector in zip(sentence, vectors):
+                token.set_embedding(self.name, vector.to(flair.device))
+        return sentences
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+def restore_embeddings(model_dir: str, embeddings: TokenEmbeddings,
+    model_names: tuple = ('best-model.pt', 'final-model.pt')):
+    """
+    Swaps the real embeddings back into taggers trained on PrecomputedEmbeddings,
+    and saves them in place.
+    """
+
+    for model_name in model_names:
+        path = os.path.join(model_dir, model_name)
+        if os.path.exists(path):
+            tagger = SequenceTagger.load(path)
+            tagger.embeddings = embeddings
+            tagger.save(path)
@@ -0,0 +1,85 @@
+"""
+This module exports a trained SequenceTagger for fast CPU inference, by dynamically
+quantizing it to int8, and checks that the export agrees with the original on the
+labeler test set. ReviewParser and Extractor load the export in place of the original
+when given its path.
+"""
+import os
+import sys
+import time
+
+import torch
+import flair
+from flair.datasets import ColumnCorpus
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from extract.modelio import QUANTIZED_SUFFIX, load_tagger, quantize_tagger, save_quantized
+
+def parity_check(original, exported, sentences, mini_batch_size: int = 32):
+    """
+    Tags the sentences with both models and returns the token accuracy of each against
+    the gold 'tag' labels, the share of tokens on which they agree, and their tagging times.
+    """
+
+    timings = {}
+    for name, model in (('original', original), ('exported', exported)):
+        start = time.time()
+        model.predict(sentences, mini_batch_size=mini_batch_size, label_name=name)
+        timings[name] = time.time() - start
+
+    total = correct_original = correct_exported = agree = 0
+    for sentence in sentences:
+        for token in sentence:
+            gold = token.get_tag('tag').value
+            original_tag = token.get_tag('original').value
+            exported_tag = token.get_tag('exported').value
+            total += 1
+            correct_original += original_tag == gold
+            correct_exported += exported_tag == gold
+            agree += original_tag == exported_tag
+
+    return {
+        'tokens': total,
+        'original_accuracy': correct_original / total,
+        'exported_accuracy': correct_exported / total,
+        'agreement': agree / total,
+        'original_seconds': timings['original'],
+        'exported_seconds': timings['exported'],
+    }
+
+def main(model_path: str = os.path.join('labeler', 'models', 'best-model.pt'),
+    max_accuracy_drop: float = 0.005):
+
+    export_path = model_path[:-len('.pt')] + QUANTIZED_SUFFIX
+
+    original = load_tagger(model_path)
+    exported = quantize_tagger(load_tagger(model_path))
+    save_quantized(exported, export_path)
+    print(f'Saved quantized tagger to {export_path}')
+
+    # make sure the saved file, not just the in-memory copy, is what we check
+    exported = load_tagger(export_path)
+
+    columns = {0: 'text', 1: 'tag'}
+    corpus = ColumnCorpus(
+        'labeler', columns,
+        train_file='train.txt',
+        test_file='test.txt',
+        dev_file='valid.txt'
+    )
+    results = parity_check(original, exported, list(corpus.test))
+    for key, value in results.items():
+        print(f'{key}: {value}')
+
+    drop = results['original_accuracy'] - results['exported_accuracy']
+    if drop > max_accuracy_drop:
+        print(f'Warning: quantization costs {drop:.4f} accuracy on the test set.')
+        return 1
+    return 0
+
+if __name__=='__main__':
+
+    # quantized kernels only run on CPU
+    flair.device = torch.device('cpu')
+    print('Using device:', flair.device)
+    sys.exit(main())
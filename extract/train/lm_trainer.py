@@ -0,0 +1,269 @@
+"""
+Streaming trainer for the character language model, with throughput logging and resumable checkpoints.
+
+It trains on the same corpus layout as flair's TextCorpus (a train/ folder of split files,
+plus valid.txt) and the same objective as flair's LanguageModelTrainer, but:
+
+- splits are read from disk in blocks of block_sequences * sequence_length * mini_batch_size
+  characters, so memory use doesn't grow with the size of a split;
+- every log_every batches it appends a JSON line to the log with the loss, chars/sec,
+  mean and max batch latency, and peak RSS of the process;
+- at the end of the first block after every checkpoint_every batches, it atomically
+  writes a checkpoint from which an interrupted run resumes at the next block.
+
+The best model on the validation set is saved as best-lm.pt, as with flair.
+"""
+import os
+import json
+import math
+import time
+import resource
+
+import torch
+from flair.data import Dictionary
+from flair.models import LanguageModel
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process, in megabytes."""
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def iter_blocks(path: str, dictionary: Dictionary, block_size: int, is_forward_lm: bool = True):
+    """
+    Reads a text file line by line and yields 1-d LongTensors of character ids of
+    block_size characters (the last one may be shorter). Each line is followed by a
+    newline character and is reversed for a backward model, as in flair's TextCorpus.
+    """
+
+    buffer = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            chars = list(line.rstrip('\n')) + ['\n']
+            if not is_forward_lm:
+                chars.reverse()
+            buffer.extend(dictionary.get_idx_for_item(char) for char in chars)
+            while len(buffer) >= block_size:
+                yield torch.tensor(buffer[:block_size], dtype=torch.long)
+                del buffer[:block_size]
+    if buffer:
+        yield torch.tensor(buffer, dtype=torch.long)
+
+def batchify(data: torch.Tensor, mini_batch_size: int) -> torch.Tensor:
+    """Lays out a block as mini_batch_size contiguous columns, dropping the remainder."""
+
+    n_rows = data.size(0) // mini_batch_size
+    return data[:n_rows * mini_batch_size].view(mini_batch_size, -1).t().contiguous()
+
+def repackage_hidden(hidden):
+    """Detaches the hidden state from the graph of the previous batch."""
+
+    return tuple(h.detach() for h in hidden)
+
+class StreamingLMTrainer:
+    """
+    :param LanguageModel model: the language model to train
+    :param str corpus_dir: folder with a train/ folder of split files and a valid.txt
+    :param str base_path: folder for best-lm.pt, the checkpoint and the log
+    """
+
+    def __init__(self, model: LanguageModel, corpus_dir: str, base_path: str,
+        is_forward_lm: bool = True):
+
+        self.model = model
+        self.corpus_dir = corpus_dir
+        self.base_path = base_path
+        self.is_forward_lm = is_forward_lm
+        self.checkpoint_path = os.path.join(base_path, 'checkpoint.pt')
+        self.log_path = os.path.join(base_path, 'training_log.jsonl')
+        self.device = next(model.parameters()).device
+
+    def split_paths(self) -> list:
+
+        train_dir = os.path.join(self.corpus_dir, 'train')
+        return [os.path.join(train_dir, name) for name in sorted(os.listdir(train_dir))]
+
+    def _log(self, record: dict):
+
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _save_checkpoint(self, optimizer, scheduler, state: dict):
+
+        # write to a temporary file first, so that an interruption never corrupts the checkpoint
+        tmp_path = self.checkpoint_path + '.tmp'
+        torch.save({
+            'model': self.model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'state': state,
+        }, tmp_path)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def evaluate(self, sequence_length: int, mini_batch_size: int, block_size: int) -> float:
+        """Returns the mean per-character loss on valid.txt."""
+
+        self.model.eval()
+        criterion = torch.nn.CrossEntropyLoss(reduction='sum')
+        total_loss = 0.0
+        total_chars = 0
+        ntokens = len(self.model.dictionary)
+        valid_path = os.path.join(self.corpus_dir, 'valid.txt')
+        with torch.no_grad():
+            for block in iter_blocks(valid_path, self.model.dictionary, block_size, self.is_forward_lm):
+                data = batchify(block, mini_batch_size).to(self.device)
+                hidden = self.model.init_hidden(mini_batch_size)
+                for i in range(0, data.size(0) - 1, sequence_length):
+                    length = min(sequence_length, data.size(0) - 1 - i)
+                    output, _, hidden = self.model.forward(data[i:i+length], hidden)
+                    targets = data[i+1:i+1+length].view(-1)
+                    total_loss += criterion(output.view(-1, ntokens), targets).item()
+                    total_chars += targets.numel()
+        self.model.train()
+        return total_loss / max(total_chars, 1)
+
+    def train(self,
+        sequence_length: int = 125,
+        mini_batch_size: int = 50,
+        max_epochs: int = 10,
+        learning_rate: float = 20.0,
+        anneal_factor: float = 0.25,
+        patience: int = 10,
+        clip: float = 0.25,
+        block_sequences: int = 100,
+        log_every: int = 100,
+        checkpoint_every: int = 1000,
+        resume: bool = False):
+        """
+        :param int sequence_length: characters per truncated backpropagation step
+        :param int mini_batch_size: number of parallel character streams
+        :param int max_epochs: passes over the training splits
+        :param float learning_rate: initial SGD learning rate
+        :param float anneal_factor: factor applied to the learning rate when validation loss plateaus
+        :param int patience: splits without improvement before annealing
+        :param float clip: gradient norm clipping threshold
+        :param int block_sequences: sequences per column read into memory at a time
+        :param int log_every: batches between throughput log records
+        :param int checkpoint_every: batches between checkpoints, which are delayed to the
+            end of the block
+        :param bool resume: whether to continue from the last checkpoint
+        """
+
+        os.makedirs(self.base_path, exist_ok=True)
+        block_size = block_sequences * sequence_length * mini_batch_size
+        ntokens = len(self.model.dictionary)
+        criterion = torch.nn.CrossEntropyLoss()
+        optimizer = torch.optim.SGD(self.model.parameters(), lr=learning_rate)
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            optimizer, mode='min', factor=anneal_factor, patience=patience)
+
+        state = {'epoch': 0, 'split': 0, 'block': 0, 'batches': 0, 'best_val_loss': math.inf}
+        if resume and os.path.exists(self.checkpoint_path):
+            checkpoint = torch.load(self.checkpoint_path, map_location=self.device)
+            self.model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            state = checkpoint['state']
+            print(f"Resuming at epoch {state['epoch']}, split {state['split']}, block {state['block']}")
+
+        split_paths = self.split_paths()
+        self.model.train()
+        checkpoint_due = False
+
+        while state['epoch'] < max_epochs:
+            while state['split'] < len(split_paths):
+                split_path = split_paths[state['split']]
+                split_start = time.time()
+                split_chars = 0
+
+                blocks = iter_blocks(split_path, self.model.dictionary, block_size, self.is_forward_lm)
+                for block_number, block in enumerate(blocks):
+                    if block_number < state['block']:
+                        continue
+                    data = batchify(block, mini_batch_size).to(self.device)
+                    hidden = self.model.init_hidden(mini_batch_size)
+
+                    interval_start = time.time()
+                    interval_chars = 0
+                    interval_loss = 0.0
+                    latencies = []
+                    for i in range(0, data.size(0) - 1, sequence_length):
+                        batch_start = time.time()
+                        length = min(sequence_length, data.size(0) - 1 - i)
+                        inputs = data[i:i+length]
+                        targets = data[i+1:i+1+length].view(-1)
+
+                        self.model.zero_grad()
+                        optimizer.zero_grad()
+                        output, _, hidden = self.model.forward(inputs, hidden)
+                        loss = criterion(output.view(-1, ntokens), targets)
+                        loss.backward()
+                        torch.nn.utils.clip_grad_norm_(self.model.parameters(), clip)
+                        optimizer.step()
+                        hidden = repackage_hidden(hidden)
+
+                        state['batches'] += 1
+                        latencies.append(time.time() - batch_start)
+                        interval_chars += targets.numel()
+                        interval_loss += loss.item()
+
+                        if state['batches'] % log_every == 0:
+                            elapsed = time.time() - interval_start
+                            self._log({
+                                'event': 'batch',
+                                'epoch': state['epoch'],
+                                'split': state['split'],
+                                'batches': state['batches'],
+                                'loss': interval_loss / len(latencies),
+                                'chars_per_sec': interval_chars / elapsed if elapsed else None,
+                                'batch_latency_mean_ms': 1000 * sum(latencies) / len(latencies),
+                                'batch_latency_max_ms': 1000 * max(latencies),
+                                'peak_rss_mb': peak_rss_mb(),
+                                'lr': optimizer.param_groups[0]['lr'],
+                            })
+                            split_chars += interval_chars
+                            interval_start = time.time()
+                            interval_chars = 0
+                            interval_loss = 0.0
+                            latencies = []
+
+                        if state['batches'] % checkpoint_every == 0:
+                            checkpoint_due = True
+
+                    split_chars += interval_chars
+                    state['block'] = block_number + 1
+                    if checkpoint_due:
+                        # checkpoints are only written between blocks, so that a resumed run
+                        # neither repeats nor skips batches (hidden state doesn't carry over blocks)
+                        self._save_checkpoint(optimizer, scheduler, state)
+                        checkpoint_due = False
+
+                val_loss = self.evaluate(sequence_length, mini_batch_size, block_size)
+                scheduler.step(val_loss)
+                if val_loss < state['best_val_loss']:
+                    state['best_val_loss'] = val_loss
+                    self.model.save(os.path.join(self.base_path, 'best-lm.pt'))
+
+                elapsed = time.time() - split_start
+                self._log({
+                    'event': 'split',
+                    'epoch': state['epoch'],
+                    'split': state['split'],
+                    'split_path': split_path,
+                    'seconds': elapsed,
+                    'chars_per_sec': split_chars / elapsed if elapsed else None,
+                    'val_loss': val_loss,
+                    'val_perplexity': math.exp(val_loss),
+                    'peak_rss_mb': peak_rss_mb(),
+                    'lr': optimizer.param_groups[0]['lr'],
+                })
+                print(f"Epoch {state['epoch']} split {state['split']}: "
+                    f"val loss {val_loss:.4f}, {split_chars / max(elapsed, 1e-9):.0f} chars/sec")
+
+                state['split'] += 1
+                state['block'] = 0
+                self._save_checkpoint(optimizer, scheduler, state)
+
+            state['epoch'] += 1
+            state['split'] = 0
+            self._save_checkpoint(optimizer, scheduler, state)
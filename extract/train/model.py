@@ -3,6 +3,7 @@ This module trains a custom language model, to be later used by the sequence lab
 Only needs to be run once for each model.
 """
 import os
+import argparse
 
 import torch
 import flair
@@ -10,7 +11,10 @@ from flair.data import Dictionary
 from flair.models import LanguageModel
 from flair.trainers.language_model_trainer import LanguageModelTrainer, TextCorpus
 
-def main():
+from lm_trainer import StreamingLMTrainer
+
+def main(streaming: bool = False, checkpoint_every: int = 1000, log_every: int = 100,
+    resume: bool = False):
     # forward vs backward
     is_forward_lm = True
 
@@ -21,12 +25,7 @@ def main():
     # the tagger to use newlines in ColumnCorpus
     dictionary.add_item('[newline]')
 
-    # our dataset is mostly made up of thousands of arbitrary abbreviations,
-    # so we specify a character-level model
-    corpus = TextCorpus(os.path.join('embeddings', 'full', 'corpus'),
-                        dictionary,
-                        is_forward_lm,
-                        character_level=True)
+    corpus_dir = os.path.join('embeddings', 'full', 'corpus')
 
     # a hidden size of 512 offers a good balance of complexity to training time
     language_model = LanguageModel(dictionary,
@@ -34,6 +33,25 @@ def main():
                                 hidden_size=1024,
                                 nlayers=1)
 
+    if streaming:
+        # reads splits from disk in blocks, logs throughput to full/training_log.jsonl
+        # and checkpoints to full/checkpoint.pt
+        trainer = StreamingLMTrainer(language_model, corpus_dir, 'full', is_forward_lm)
+        trainer.train(sequence_length=125,
+                    mini_batch_size=50,
+                    max_epochs=10,
+                    log_every=log_every,
+                    checkpoint_every=checkpoint_every,
+                    resume=resume)
+        return
+
+    # our dataset is mostly made up of thousands of arbitrary abbreviations,
+    # so we specify a character-level model
+    corpus = TextCorpus(corpus_dir,
+                        dictionary,
+                        is_forward_lm,
+                        character_level=True)
+
     # train model
     trainer = LanguageModelTrainer(language_model, corpus)
     trainer.train('full',
@@ -48,4 +66,15 @@ if __name__=='__main__':
     else:
         print('Using device:', flair.device)
 
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--streaming', action='store_true',
+        help='train with the streaming trainer, which logs throughput and checkpoints as it goes')
+    arg_parser.add_argument('--checkpoint-every', type=int, default=1000,
+        help='batches between checkpoints of the streaming trainer')
+    arg_parser.add_argument('--log-every', type=int, default=100,
+        help='batches between throughput log records of the streaming trainer')
+    arg_parser.add_argument('--resume', action='store_true',
+        help='resume the streaming trainer from its last checkpoint')
+    args = arg_parser.parse_args()
+    main(streaming=args.streaming, checkpoint_every=args.checkpoint_every,
+        log_every=args.log_every, resume=args.resume)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import argparse
 
 import torch
 import flair
@@ -9,7 +10,10 @@ from flair.embeddings import FlairEmbeddings
 from flair.models import SequenceTagger
 from flair.trainers import ModelTrainer
 
-def main():
+from embcache import (PrecomputedEmbeddings, inputs_fingerprint, precompute,
+    restore_embeddings, store_exists)
+
+def main(precompute_embeddings: bool = False):
 
     columns = {0: 'text', 1: 'tag'}
 
@@ -24,8 +28,19 @@ def main():
 
     tag_dictionary = corpus.make_tag_dictionary('tag')
 
-    embeddings = FlairEmbeddings(os.path.join(
-        'embeddings', 'full', 'spec_newline', 'best-lm.pt'))
+    lm_path = os.path.join('embeddings', 'full', 'spec_newline', 'best-lm.pt')
+    embeddings = FlairEmbeddings(lm_path)
+
+    if precompute_embeddings:
+        # the language model is frozen, so embed the corpus once instead of every epoch
+        flair_embeddings = embeddings
+        store_path = os.path.join(data_folder, 'embeddings')
+        # rebuild the store whenever the language model or the corpus has changed
+        fingerprint = inputs_fingerprint(lm_path, *(os.path.join(data_folder, name)
+            for name in ('train.txt', 'test.txt', 'valid.txt')))
+        if not store_exists(store_path, fingerprint):
+            precompute(embeddings, corpus.get_all_sentences(), store_path, fingerprint=fingerprint)
+        embeddings = PrecomputedEmbeddings(store_path)
 
     tagger: SequenceTagger = SequenceTagger(
         hidden_size=256,
@@ -37,13 +52,19 @@ def main():
 
     trainer : ModelTrainer = ModelTrainer(tagger, corpus)
 
+    model_dir = os.path.join('extractor', 'simmodel')
     trainer.train(
-        os.path.join('extractor', 'simmodel'),
+        model_dir,
         learning_rate=0.1,
         mini_batch_size=64,
-        max_epochs=150
+        max_epochs=150,
+        # embeddings are read from the store as needed, so don't keep them in memory
+        embeddings_storage_mode='none' if precompute_embeddings else 'cpu'
     )
 
+    if precompute_embeddings:
+        restore_embeddings(model_dir, flair_embeddings)
+
 if __name__=='__main__':
 
     if not torch.cuda.is_available():
@@ -51,4 +72,9 @@ if __name__=='__main__':
     else:
         print("Using device: ", flair.device)
     print(torch.cuda.is_available())
-    main()
\ No newline at end of file
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--precompute-embeddings', action='store_true',
+        help='embed the corpus with the frozen language model once, and train from the stored embeddings')
+    args = arg_parser.parse_args()
+    main(precompute_embeddings=args.precompute_embeddings)
\ No newline at end of file
@@ -1,13 +1,139 @@
 import os
+import json
+import argparse
+import cProfile
+from collections import deque
+from multiprocessing import Pool
 
 import pandas as pd
-from flair.data import Sentence
 
-from extract.reviewparser import ReviewParser
-from extract.tokenizer import ReviewTokenizer
+from extract.metrics import StageMetrics
+from extract.reviewparser import ReviewParser, TextSentence
+from extract.tagindex import TagIndex
+from reader import iter_rows
+from tagmap import get_tag_map
 
 
-def main():
+COLUMNS = ['author', 'title', 'J', 'V', 'M', 'D', 'Y', 'P', 'L']
+JOURNAL_COLUMNS = ['journal', 'journal_confidence']
+MODEL_PATH = os.path.join('extract', 'train', 'labeler', 'models', 'best-model.pt')
+
+def parse_rows(parser: ReviewParser, rows, mini_batch_size: int = 32):
+    """
+    Parses a list of (author, title, review_string) tuples in a single batch and returns
+    a flat list of review dicts, one per review, tagged with the author and title of its row.
+    """
+
+    # the parser tokenizes into flair Sentences only the rows it sends to the tagger
+    sentences = [TextSentence(review_string) for (_, _, review_string) in rows]
+    parsed = parser.parse_batch(sentences, mini_batch_size=mini_batch_size)
+
+    review_df_rows = []
+    for (author, title, _), reviews in zip(rows, parsed):
+        for review in reviews:
+            review['author'] = author
+            review['title'] = title
+        review_df_rows.extend(reviews)
+
+    return review_df_rows
+
+# each worker process loads its own copy of the tagger exactly once
+_worker_parser = None
+
+def _init_worker(model_path: str, num_threads: int = 0, cache_path: str = '', cascade: bool = False,
+    resolve_journals: bool = False):
+
+    global _worker_parser
+    if num_threads and model_path:
+        # keep worker processes from oversubscribing the cores with torch's own thread pool
+        import torch
+        torch.set_num_threads(num_threads)
+    tag_index = TagIndex(get_tag_map()) if resolve_journals else None
+    _worker_parser = ReviewParser(model_path, cache_path=cache_path, cascade=cascade, tag_index=tag_index)
+
+def _parse_shard(args):
+
+    rows, batch_size, mini_batch_size = args
+    _worker_parser.cascade_counts = {'regex': 0, 'tagger': 0}
+    _worker_parser.metrics.reset()
+    cache = _worker_parser.cache
+    # the cache counts over the life of the worker, so report only this shard's share
+    hits, misses = (cache.hits, cache.misses) if cache else (0, 0)
+    review_df_rows = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start+batch_size]
+        review_df_rows.extend(parse_rows(_worker_parser, batch, mini_batch_size))
+    cache_counts = {'hits': 0, 'misses': 0}
+    if cache:
+        cache.commit()
+        cache_counts = {'hits': cache.hits - hits, 'misses': cache.misses - misses}
+    return (len(rows), review_df_rows, _worker_parser.cascade_counts, cache_counts,
+        _worker_parser.metrics.state())
+
+def _imap_bounded(pool, func, iterable, max_pending: int):
+    """
+    Like Pool.imap, but only reads max_pending items ahead of the results, so that
+    a streamed input is never pulled into memory all at once. As each result is
+    yielded, the next item is submitted, so the workers never wait on the slowest
+    item of a group.
+    """
+
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Returns the checkpoint state, a dict mapping each spreadsheet filename to the number
+    of rows already parsed, the size of its output file at that point and whether it is done.
+    Under 'options' it also holds the options the output was written with.
+    """
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path: str, state: dict):
+
+    # write to a temporary file first, so that a crash never leaves a half-written checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _write_checkpoint(review_df_rows, columns, dest_path, count, checkpoint, fn, checkpoint_path, done=False,
+    metrics: StageMetrics = None):
+    """Appends parsed rows to the output file, then records the progress in the checkpoint."""
+
+    metrics = metrics if metrics is not None else StageMetrics()
+    with metrics.time('write', len(review_df_rows)):
+        df = pd.DataFrame(review_df_rows, columns=columns)
+        df.to_csv(dest_path, mode='a', header=False, index=False, sep='\t')
+    checkpoint[fn] = {'rows': count, 'bytes': os.path.getsize(dest_path), 'done': done}
+    save_checkpoint(checkpoint_path, checkpoint)
+
+def main(batch_size: int = 1000, mini_batch_size: int = 32, workers: int = 1, shard_size: int = 20000,
+    cache_path: str = '', checkpoint_every: int = 20000, resume: bool = False, cascade: bool = False,
+    resolve_journals: bool = False, model_path: str = MODEL_PATH, metrics_path: str = ''):
+    """
+    :param int batch_size: number of spreadsheet rows handed to the parser at once
+    :param int mini_batch_size: number of sentences per call to the tagger's predict
+    :param int workers: number of worker processes; 1 parses in the main process
+    :param int shard_size: number of spreadsheet rows per worker task when workers > 1
+    :param str cache_path: optional path to an on-disk parse cache shared across runs
+    :param int checkpoint_every: number of spreadsheet rows between writes to disk
+    :param bool resume: continue from the last checkpoint instead of starting over
+    :param bool cascade: resolve well-formed review strings by regex and tag only the rest
+    :param bool resolve_journals: add the journal title matched to each J field by the shared tag map
+    :param str model_path: path to the review tagger; if empty, only journals are parsed, by regex
+    :param str metrics_path: where to write per-stage timings, as Prometheus text if it ends
+        with .prom and as JSON otherwise
+    """
 
     # fnames for raw data
     filenames = [
@@ -17,49 +143,148 @@ def main():
         '1998-2000.csv'
     ]
 
-    # instantiate parser object
-    parser = ReviewParser(
-        os.path.join('extract', 'train', 'labeler', 'models', 'best-model.pt')
-    )
-    tokenizer = ReviewTokenizer()
-
-    for i, fn in enumerate(filenames):
-
-        path = os.path.join('data', 'raw', fn)
-        raw = pd.read_csv(path, encoding='latin-1')
-
-        print(f'Parsing spreadsheet #{i+1}')
-        # list of dicts, where each dict is one parsed review
-        review_df_rows = []
-        count = 0
-        for row in raw.itertuples(index=False):
-
-            author = row.Author
-            title = row.Title
-            review_string = row.Review
-            sentence = Sentence(
-                review_string,
-                use_tokenizer = tokenizer
-            )
-            reviews = parser.parse(sentence) # returns list of dicts
-            for review in reviews:
-                review['author'] = author
-                review['title'] = title
-            review_df_rows.extend(reviews)
-            count += 1
-            if count % 1000 == 0:
+    checkpoint_path = os.path.join('data', 'processed', 'checkpoint.json')
+    checkpoint = load_checkpoint(checkpoint_path) if resume else {}
+    # options that change what is written; rows parsed under other options can't be appended to
+    options = {'model_path': model_path, 'resolve_journals': resolve_journals}
+    if checkpoint.get('options', options) != options:
+        raise ValueError(
+            f'Cannot resume: the checkpoint was written with {checkpoint["options"]}, not {options}. '
+            'Rerun with the same options, or without --resume to start over.'
+        )
+    checkpoint['options'] = options
+    columns = COLUMNS + JOURNAL_COLUMNS if resolve_journals else COLUMNS
+    metrics = StageMetrics()
+    cache_counts = {'hits': 0, 'misses': 0}
+
+    pool = None
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker, initargs=(model_path, 1, cache_path, cascade, resolve_journals))
+    else:
+        # instantiate parser object
+        _init_worker(model_path, cache_path=cache_path, cascade=cascade, resolve_journals=resolve_journals)
+
+    try:
+        for i, fn in enumerate(filenames):
+
+            dest_path = os.path.join('data', 'processed', f'data{i+1}.tsv')
+            state = checkpoint.get(fn, {'rows': 0, 'bytes': 0, 'done': False})
+            if state['done']:
+                print(f'Skipping spreadsheet #{i+1}, already parsed.')
+                continue
+
+            if state['rows'] and os.path.exists(dest_path) and os.path.getsize(dest_path) >= state['bytes']:
+                # drop anything written after the last checkpoint
+                with open(dest_path, 'r+b') as f:
+                    f.truncate(state['bytes'])
+                print(f'Resuming spreadsheet #{i+1} at row {state["rows"]}')
+            else:
+                if state['rows']:
+                    print(f'Output of spreadsheet #{i+1} is missing or shorter than the checkpoint, starting over.')
+                    state = {'rows': 0, 'bytes': 0, 'done': False}
+                pd.DataFrame(columns=columns).to_csv(dest_path, index=False, sep='\t')
+
+            path = os.path.join('data', 'raw', fn)
+
+            print(f'Parsing spreadsheet #{i+1}')
+            # list of dicts, where each dict is one parsed review not yet written to disk
+            review_df_rows = []
+            count = state['rows']
+            if workers > 1:
+                # split the spreadsheet into row ranges; imap hands results back in shard order,
+                # so the merged output keeps the original row order
+                shards = (
+                    (rows, batch_size, mini_batch_size)
+                    for rows in metrics.timed_iter('read', iter_rows(path, batch_size=shard_size, skip_rows=count))
+                )
+                results = _imap_bounded(pool, _parse_shard, shards, 2 * workers)
+            else:
+                results = (
+                    _parse_shard((rows, batch_size, mini_batch_size))
+                    for rows in metrics.timed_iter('read', iter_rows(path, batch_size=batch_size, skip_rows=count))
+                )
+            last_checkpoint = count
+            cascade_counts = {'regex': 0, 'tagger': 0}
+            for n_rows, reviews, shard_counts, shard_cache_counts, shard_metrics in results:
+
+                review_df_rows.extend(reviews)
+                count += n_rows
+                for path_taken, n in shard_counts.items():
+                    cascade_counts[path_taken] += n
+                for outcome, n in shard_cache_counts.items():
+                    cache_counts[outcome] += n
+                metrics.merge(shard_metrics)
                 print(f'Parsed {count} rows.')
+                if count - last_checkpoint >= checkpoint_every:
+                    _write_checkpoint(review_df_rows, columns, dest_path, count, checkpoint, fn, checkpoint_path,
+                        metrics=metrics)
+                    review_df_rows = []
+                    last_checkpoint = count
 
-        print(f'Saving spreadsheet #{i}')
-        df = pd.DataFrame(review_df_rows)
-        df = df[['author', 'title', 'J', 'V', 'M', 'D', 'Y', 'P', 'L']]
-        df.to_csv(
-            os.path.join('data', 'processed', f'data{i+1}.tsv'),
-             index=False,
-             sep='\t'
-        )
+            if cascade:
+                total = cascade_counts['regex'] + cascade_counts['tagger']
+                ratio = cascade_counts['regex'] / total if total else 0.0
+                print(f'Cascade: {cascade_counts["regex"]} rows resolved by regex, '
+                      f'{cascade_counts["tagger"]} sent to tagger ({ratio:.1%} regex).')
+
+            print(f'Saving spreadsheet #{i+1}')
+            _write_checkpoint(review_df_rows, columns, dest_path, count, checkpoint, fn, checkpoint_path, done=True,
+                metrics=metrics)
+    finally:
+        if pool is not None:
+            # every result has been read by now, unless parsing failed
+            pool.terminate()
+            pool.join()
+
+    if cache_path and model_path:
+        print(f'Parse cache: {cache_counts["hits"]} hits, {cache_counts["misses"]} misses.')
+    if workers == 1 and _worker_parser.cache:
+        _worker_parser.cache.close()
+
+    print(metrics.report())
+    if metrics_path:
+        metrics.save(metrics_path)
 
 if __name__=='__main__':
 
-    main()
+    arg_parser = argparse.ArgumentParser(description='Parse raw BRI spreadsheets with the review tagger.')
+    arg_parser.add_argument('--model', default=MODEL_PATH,
+        help="path to the review tagger, or to its quantized .int8.pt export; "
+        "pass '' to parse journals by regex without loading flair")
+    arg_parser.add_argument('--batch-size', type=int, default=1000)
+    arg_parser.add_argument('--mini-batch-size', type=int, default=32)
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--shard-size', type=int, default=20000)
+    arg_parser.add_argument('--cache', default='', help='path to an on-disk parse cache')
+    arg_parser.add_argument('--checkpoint-every', type=int, default=20000)
+    arg_parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint')
+    arg_parser.add_argument('--cascade', action='store_true',
+        help='parse well-formed review strings by regex and send only the rest to the tagger')
+    arg_parser.add_argument('--resolve-journals', action='store_true',
+        help='add the journal title matched to each review by the shared tag map')
+    arg_parser.add_argument('--metrics', default='',
+        help='write per-stage timings to this path, as Prometheus text if it ends with .prom, else JSON')
+    arg_parser.add_argument('--profile', default='',
+        help='profile the main process with cProfile and write the stats to this path')
+    args = arg_parser.parse_args()
 
+    # py-spy can attach to a run without any hook; cProfile needs enabling in-process
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    main(
+        batch_size=args.batch_size,
+        mini_batch_size=args.mini_batch_size,
+        workers=args.workers,
+        shard_size=args.shard_size,
+        cache_path=args.cache,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
+        cascade=args.cascade,
+        resolve_journals=args.resolve_journals,
+        model_path=args.model,
+        metrics_path=args.metrics
+    )
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
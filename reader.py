@@ -0,0 +1,39 @@
+"""
+Streaming access to the raw Book Review Index spreadsheets.
+
+The raw .csv files are large enough that loading all of them at once dominates the
+memory use of the preprocessing scripts, so both preprocess.py and data_prep.py read
+them through this module in fixed-size batches instead.
+"""
+import pandas as pd
+
+RAW_COLUMNS = ['Author', 'Title', 'Review']
+
+def iter_batches(path: str, batch_size: int = 10000, skip_rows: int = 0):
+    """
+    Yields DataFrames of at most batch_size rows holding the Author, Title and
+    Review columns of a raw spreadsheet, in file order.
+
+    :param str path: path to a raw BRI .csv file
+    :param int batch_size: number of spreadsheet rows per batch
+    :param int skip_rows: number of data rows (not counting the header) to skip
+    """
+
+    reader = pd.read_csv(
+        path,
+        encoding='latin-1',
+        usecols=RAW_COLUMNS,
+        chunksize=batch_size,
+        # keep the header row, skip data rows 1..skip_rows
+        skiprows=range(1, skip_rows + 1) if skip_rows else None,
+    )
+    for batch in reader:
+        yield batch[RAW_COLUMNS]
+
+def iter_rows(path: str, batch_size: int = 10000, skip_rows: int = 0):
+    """
+    Yields lists of (author, title, review_string) tuples, one list per batch.
+    """
+
+    for batch in iter_batches(path, batch_size=batch_size, skip_rows=skip_rows):
+        yield list(zip(batch.Author, batch.Title, batch.Review))
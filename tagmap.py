@@ -0,0 +1,180 @@
+"""
+Shared access to the map between BRI journal abbreviations and journal titles.
+
+Building the map means reading every tag spreadsheet and the OCR corrections with pandas,
+so the merged result is cached next to the spreadsheets in a pickle, one per list of
+source files. The cache is rebuilt whenever one of the source files changes. Within a
+process the map is loaded once, on first use, and shared by every caller.
+"""
+import os
+import pickle
+import hashlib
+
+TAGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tags')
+TAG_PATHS = [
+    os.path.join(TAGS_DIR, '1965-1985.tsv'),
+    os.path.join(TAGS_DIR, '2000.tsv'),
+]
+OCR_FIXES_PATH = os.path.join(TAGS_DIR, 'OCR_corrections_1965.tsv')
+CACHE_PATH = os.path.join(TAGS_DIR, '.tagmap_cache.pickle')
+
+# bump whenever the layout of the cached data, or the way it is built, changes
+CACHE_VERSION = 3
+
+_loaded = {}
+
+def _file_hash(path: str) -> str:
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _source_state(paths: list) -> dict:
+    """Returns the modification time and size of each source file. Hashes are only
+    computed when needed."""
+
+    state = {}
+    for path in paths:
+        stat = os.stat(path)
+        state[path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': None}
+    return state
+
+def _is_fresh(cached: dict, current: dict) -> bool:
+    """A cached source is fresh if its mtime and size are unchanged, or failing that,
+    if its contents hash to the same value (e.g. the file was only touched)."""
+
+    if cached.keys() != current.keys():
+        return False
+    for path, state in current.items():
+        old = cached[path]
+        if old['size'] != state['size']:
+            return False
+        if old['mtime'] != state['mtime'] and old['sha1'] != _file_hash(path):
+            return False
+    return True
+
+def build_tag_map(tag_paths: list, ocr_fixes_path: str):
+    """
+    Reads the tag spreadsheets and OCR fixes and returns two dicts: one mapping BRI
+    abbreviations to journal titles, and one mapping journal titles to their publication
+    frequency.
+
+    Each spreadsheet is completed with the OCR fixes and space-stripped variants of its own
+    tags before the spreadsheets are merged, and later spreadsheets take precedence over
+    earlier ones. So a fix or stripped variant derived from a later spreadsheet overrides a
+    tag of an earlier one, as when each spreadsheet was loaded on its own and the maps were
+    merged with |.
+    """
+
+    import pandas as pd
+
+    # this one contains quick fixes for the most common OCR erros
+    fixes_df = pd.read_csv(ocr_fixes_path, sep='\t')
+
+    tag_map = {}
+    frequencies = {}
+    for path in tag_paths:
+
+        # these spreadsheets contain mappings between BRI abbreviations and journal names
+        tag_df = pd.read_csv(path, sep='\t')
+
+        # generate a dict to map between abbreviations and names
+        sheet_map = {tag: title for (tag, title) in zip(tag_df['tag'], tag_df['title'])}
+        for tag, title in zip(fixes_df['tag'], fixes_df['title']):
+            if tag not in sheet_map:
+                sheet_map[tag] = title
+
+        # the most common OCR error is a missing space
+        # luckily, we can safely strip spaces and check against that
+        for tag in list(sheet_map):
+            if ' ' in tag:
+                sheet_map[tag.replace(' ', '')] = sheet_map[tag]
+
+        tag_map.update(sheet_map)
+
+        if 'frequency' in tag_df:
+            for title, frequency in zip(tag_df['title'], tag_df['frequency']):
+                if isinstance(frequency, str):
+                    frequencies[title] = frequency
+
+    return tag_map, frequencies
+
+def _cache_file(cache_path: str, paths: list) -> str:
+    """
+    Returns the cache file for the given source files: cache_path with a hash of the paths
+    added before the extension, so callers with different spreadsheets don't overwrite each
+    other's cache. The paths are hashed in order, since later spreadsheets take precedence.
+    """
+
+    key = '\n'.join(os.path.abspath(path) for path in paths)
+    root, ext = os.path.splitext(cache_path)
+    return f'{root}.{hashlib.sha1(key.encode()).hexdigest()[:12]}{ext}'
+
+def _save(data: dict, cache_path: str):
+
+    # write to a temporary file first, so that readers never see a partial cache
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+def _load(tag_paths: list, ocr_fixes_path: str, cache_path: str) -> dict:
+
+    key = (tuple(tag_paths), ocr_fixes_path, cache_path)
+    if key in _loaded:
+        return _loaded[key]
+
+    paths = list(tag_paths) + [ocr_fixes_path]
+    sources = _source_state(paths)
+    data = None
+    if cache_path:
+        cache_path = _cache_file(cache_path, paths)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            if (cached.get('version') == CACHE_VERSION and cached['paths'] == paths
+                    and _is_fresh(cached['sources'], sources)):
+                data = cached
+                if any(cached['sources'][p]['mtime'] != s['mtime'] for p, s in sources.items()):
+                    # contents unchanged; record the new mtimes so we don't hash again next time
+                    for path, state in sources.items():
+                        data['sources'][path]['mtime'] = state['mtime']
+                    _save(data, cache_path)
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+            data = None
+
+    if data is None:
+        tag_map, frequencies = build_tag_map(tag_paths, ocr_fixes_path)
+        for path, state in sources.items():
+            state['sha1'] = _file_hash(path)
+        data = {
+            'version': CACHE_VERSION,
+            'paths': paths,
+            'sources': sources,
+            'tag_map': tag_map,
+            'frequencies': frequencies,
+        }
+        if cache_path:
+            _save(data, cache_path)
+
+    _loaded[key] = data
+    return data
+
+def get_tag_map(tag_paths: list = None, ocr_fixes_path: str = None,
+    cache_path: str = CACHE_PATH) -> dict:
+    """
+    Returns the dictionary that maps BRI abbreviations to journal titles, built from the
+    default tag spreadsheets unless others are given. The on-disk cache for each list of
+    spreadsheets is kept next to cache_path; pass cache_path='' to skip it.
+    """
+
+    return _load(tag_paths or TAG_PATHS, ocr_fixes_path or OCR_FIXES_PATH, cache_path)['tag_map']
+
+def get_frequencies(tag_paths: list = None, ocr_fixes_path: str = None,
+    cache_path: str = CACHE_PATH) -> dict:
+    """
+    Returns a dictionary that maps journal titles to their publication frequency
+    (weekly, monthly, quarterly, ...), from the frequency column of the tag spreadsheets.
+    """
+
+    return _load(tag_paths or TAG_PATHS, ocr_fixes_path or OCR_FIXES_PATH, cache_path)['frequencies']
@@ -0,0 +1,58 @@
+"""
+Tests for the chunked extraction loop of Extractor, with a stand-in for the tagger.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+pytest.importorskip('flair')
+
+from extract.extractor import Extractor
+from extract.tokenizer import ExtractTokenizer
+
+class PrefixTagger:
+    """
+    Tags each token by its first two letters: AU as an author, TI as a title, RV as a review.
+    [newline] tokens are tagged as reviews too.
+    """
+
+    TAGS = {'AU': 'A', 'TI': 'T', 'RV': 'R', '[n': 'R'}
+
+    def predict(self, sentences, mini_batch_size: int = 32):
+
+        for sentence in sentences if isinstance(sentences, list) else [sentences]:
+            for token in sentence:
+                tag = self.TAGS.get(token.text[:2])
+                token.add_tag('ner', f'S-{tag}' if tag else 'O')
+
+def fields(entries):
+
+    return [(entry.start_pos, entry.end_pos, entry.full_string) for entry in entries]
+
+def test_undecodable_byte(tmp_path):
+
+    # a latin-1 é in a file read as utf-8
+    text = ''.join(f'AU{i} TI{i}\xe9 RV{i} - RV{i}\n' for i in range(40))
+    path = tmp_path / 'volume.txt'
+    path.write_bytes(text.encode('latin-1'))
+    extractor = Extractor(PrefixTagger(), ExtractTokenizer(), chunk_size=100)
+
+    in_memory = extractor.extract(path.read_text(encoding='utf-8', errors='surrogateescape'))
+    mapped = list(extractor.iter_extract_file(str(path)))
+    assert len(in_memory) == 40
+    assert fields(mapped) == fields(in_memory)
+    assert extractor.extract_file(str(path), str(tmp_path / 'volume.tsv')) == 40
+
+def test_entry_ends_on_newline():
+
+    # every entry ends with a review span made of the newline token
+    lines = [f'AU{i} TI{i} RV{i}\n' for i in range(40)]
+    text = ''.join(lines)
+    extractor = Extractor(PrefixTagger(), ExtractTokenizer(), chunk_size=100)
+
+    entries = extractor.extract(text)
+    assert [entry.full_string for entry in entries] == lines
+    assert entries[0].reviews == ['RV0', '\n']
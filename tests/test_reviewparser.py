@@ -0,0 +1,57 @@
+"""
+Tests for the strict regex that ReviewParser's cascade mode trusts without the tagger.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from extract.reviewparser import ReviewParser, TextSentence
+
+def strict_parse(text: str):
+
+    return ReviewParser._strict_regex_parse(TextSentence(text).to_original_text())
+
+def test_well_formed_reviews():
+
+    reviews = strict_parse("Choice - v35 - D '97 - p690 - [51-250] - H-Net - F '98 - ONL [501+]")
+    assert reviews == [
+        {'J': 'Choice', 'V': 'v35', 'M': 'D', 'Y': '97', 'P': 'p690', 'L': '[51 - 250]'},
+        {'J': 'H - Net', 'M': 'F', 'Y': '98', 'P': 'ONL', 'L': '[501+]'},
+    ]
+
+def test_multiword_journal():
+
+    assert strict_parse("New R - v12 - S 3 '80 - p3") == [
+        {'J': 'New R', 'V': 'v12', 'M': 'S', 'D': '3', 'Y': '80', 'P': 'p3'},
+    ]
+
+def test_dropped_dash_between_reviews():
+
+    assert strict_parse("LJ - v120 - Ja 15 '95 - p12 BL - v91 - Mr 1 '95 - p1200") is None
+    assert strict_parse("Choice - v35 - D '97 - p690 BL - '98 - p3") is None
+
+def test_dropped_dash_after_journal():
+
+    assert strict_parse("Choice v35 - D '97 - p690") is None
+    assert strict_parse("LJ - v120 - Ja 15 '95 - p12 - BL v91 - Mr 1 '95 - p1200") is None
+
+def test_dropped_dash_before_date():
+
+    assert strict_parse("LJ - v120 Ja 15 '95 - p12") is None
+
+def test_journal_never_spans_fields():
+
+    for text in [
+        "LJ - v120 - Ja 15 '95 - p12 BL - v91 - Mr 1 '95 - p1200",
+        "Choice v35 - D '97 - p690",
+        "Choice - v35 - D '97 - p690 - [51-250] - H-Net - F '98 - ONL [501+]",
+        "Atl - '80 - p3 - Sat R - v4 - '81 - p9",
+    ]:
+        for review in strict_parse(text) or []:
+            assert ' - ' not in review['J'].replace('H - Net', '')
+            assert not any(c.isdigit() for c in review['J'])
+
+def test_implausible_year():
+
+    assert strict_parse("LJ - v120 - Ja 15 '45 - p12") is None
@@ -0,0 +1,39 @@
+"""
+Tests for the fuzzy journal index and its use by ReviewParser.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from extract.reviewparser import ReviewParser, TextSentence
+from extract.tagindex import TagIndex, ocr_distance, CONFUSION_COST
+
+TAG_MAP = {
+    'Choice': 'Choice',
+    'Lib': 'Library',
+    'CQ': 'Carolina Quarterly',
+    'Modern Age': 'Modern Age',
+}
+
+def test_multi_character_confusion():
+
+    assert ocr_distance('Modern', 'Modem') == CONFUSION_COST
+    assert ocr_distance('Modem', 'Modern') == CONFUSION_COST
+    assert ocr_distance('cl', 'd') == CONFUSION_COST
+
+def test_r_and_n_are_not_confusable():
+
+    assert ocr_distance('bar', 'ban') == 1.0
+
+def test_lookup_through_ocr_errors():
+
+    index = TagIndex(TAG_MAP)
+    assert index.lookup('ModemAge').title == 'Modern Age'
+    assert index.lookup('Chioce').title == 'Choice'
+
+def test_parser_leaves_out_low_confidence_matches():
+
+    parser = ReviewParser(tag_index=TagIndex(TAG_MAP))
+    reviews = parser.parse(TextSentence("Chioce - v35 - D '97 - p690 - ab - '98 - p3 - Q - '99 - p4"))
+    assert [review.get('journal') for review in reviews] == ['Choice', None, None]
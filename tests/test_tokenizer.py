@@ -0,0 +1,45 @@
+"""
+Checks the regex tokenizers against the character loops they replaced (kept in
+benchmarks/reference_tokenizers.py), on random strings made of every separator the loops
+treated specially.
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from extract.tokenizer import review_tokens, extract_tokens
+from benchmarks.reference_tokenizers import loop_review_tokens, loop_extract_tokens
+
+ALPHABET = " '-\n\tab[]1+"
+
+def random_strings(n: int, seed: int = 0):
+
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 30)))
+
+def test_review_tokens_match_loop():
+
+    for text in random_strings(50000):
+        assert review_tokens(text) == loop_review_tokens(text), repr(text)
+
+def test_extract_tokens_match_loop():
+
+    for text in random_strings(50000, seed=1):
+        assert extract_tokens(text) == loop_extract_tokens(text), repr(text)
+
+def test_review_string():
+
+    assert review_tokens("Choice - v35 - D '97") == [
+        ('Choice', 0, True), ('-', 7, True), ('v35', 9, True), ('-', 13, True),
+        ('D', 15, True), ('97', 18, False),
+    ]
+
+def test_extract_newline():
+
+    assert extract_tokens("SMITH, J -\nThe") == [
+        ('SMITH,', 0, True), ('J', 7, True), ('-', 9, False), ('[newline]', 10, False),
+        ('The', 11, False),
+    ]